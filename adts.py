@@ -1,30 +1,94 @@
-class Tree:
+import hashlib
+
+# A node of a tree of comments. Every node uses __slots__, leaves share an
+# empty tuple instead of each having their own empty list of children, and all
+# traversals are iterative, so that large and deep threads are cheap and safe.
+class Tree(object):
+    __slots__ = ('item', 'parent', 'children', 'index')
+
     def __init__(self, item, parent=None):
         self.item = item
         self.parent = parent
-        self.children = []
+        self.children = ()
+        # Maps comment ids to nodes, shared by every node in the tree
+        self.index = parent.index if parent is not None else {}
+        comment_id = getattr(item, 'id', None)
+        if comment_id is not None:
+            self.index[comment_id] = self
 
     def add_child(self, item):
         child = Tree(item, self)
-        self.children.append(child)
+        if self.children:
+            self.children.append(child)
+        else:
+            self.children = [child]
         return child
 
+    # Returns: The node in this tree whose comment has the given id, or None.
+    def find(self, comment_id):
+        return self.index.get(comment_id)
+
+    # Yields every node of the tree, each one before all of its descendants
+    # and after all of its earlier siblings and their descendants.
+    def preorder(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    # A tree is pickled as a flat list of (item, position of parent) pairs
+    # in pre-order, so that deep trees don't hit the recursion limit.
+    def __getstate__(self):
+        nodes = list(self.preorder())
+        positions = { node:i for i, node in enumerate(nodes) }
+        return [(node.item, positions.get(node.parent)) for node in nodes]
+
+    def __setstate__(self, state):
+        Tree.__init__(self, state[0][0])
+        nodes = [self]
+        for item, parent_position in state[1:]:
+            nodes.append(nodes[parent_position].add_child(item))
+
     def __str__(self):
         return self.str_help()
 
     def str_help(self, indent=''):
-        if not self.children:
-            return indent + str(self.item)
-        recurse = [c.str_help(indent + '  ') for c in self.children]
-        return indent + str(self.item) + '\n' + '\n'.join(recurse)
+        lines = []
+        stack = [(self, indent)]
+        while stack:
+            node, node_indent = stack.pop()
+            lines.append(node_indent + str(node.item))
+            stack.extend((c, node_indent + '  ') for c in reversed(node.children))
+        return '\n'.join(lines)
+
+    # Returns: A dictionary mapping each node of the tree to a fingerprint of
+    # the ids of all the comments in its subtree. The fingerprint of a node
+    # changes whenever a comment is added anywhere below it.
+    def fingerprints(self):
+        result = {}
+        # Going backwards through the pre-order handles children before parents
+        for node in reversed(list(self.preorder())):
+            digest = hashlib.sha1(getattr(node.item, 'id', '').encode('utf-8') + '\n')
+            for child in node.children:
+                digest.update(result[child])
+            result[node] = digest.hexdigest()
+        return result
+
+class Comment(object):
+    __slots__ = ()
 
-class Comment:
     def __init__(self):
         pass
 
 class RealComment(Comment):
+    __slots__ = ('website', 'post', 'id', 'url', 'username', 'is_owner_comment',
+                 'content', 'timestamp')
+
     # website, post and id together should uniquely identify a comment
-    def __init__(self, website, post, id, url, username, is_owner, content):
+    # timestamp: When the comment was made, as a string that sorts in time
+    # order, or None if the website doesn't tell us.
+    def __init__(self, website, post, id, url, username, is_owner, content, timestamp=None):
         Comment.__init__(self)
         self.website = website
         self.post = post
@@ -33,6 +97,7 @@ class RealComment(Comment):
         self.username = username
         self.is_owner_comment = is_owner
         self.content = content
+        self.timestamp = timestamp
 
     def __str__(self):
         message = self.content
@@ -44,19 +109,87 @@ class FakeComment(Comment):
     # For things like pointers to comments, or things where the
     # comment score is below a threshold and so the comment text isn't
     # visible, etc.
+    __slots__ = ('stuff',)
+
     def __init__(self, stuff):
         Comment.__init__(self)
         self.stuff = stuff
 
+class CommentPointer(FakeComment):
+    # Stands in for a comment that was fetched before, so that new replies to
+    # it can be put in a Tree without fetching it again.
+    __slots__ = ('website', 'post', 'id')
+
+    def __init__(self, website, post, id):
+        FakeComment.__init__(self, id)
+        self.website = website
+        self.post = post
+        self.id = id
+
 class Post:
     def __init__(self, disqus_id, other_ids):
         self.disqus_id = disqus_id
         self.other_ids = other_ids
         self.copied_comments = { k:{} for k in other_ids }
+        # Maps each website to a dictionary from thread ids to the high-water
+        # mark of that thread: a dictionary with the newest timestamp seen
+        # ('newest'), the fingerprint of the whole thread ('fingerprint') and
+        # the fingerprints of each top level comment ('branches') as of the
+        # last time every comment in the thread was copied.
+        self.high_water = { k:{} for k in other_ids }
 
     def __str__(self):
         return 'Post #' + str(self.disqus_id) + ' with comments ' + str(self.copied_comments)
 
     def has_same_links(self, other):
         return self.disqus_id == other.disqus_id and self.other_ids == other.other_ids
+
+    # website: Which website to get thread ids for.
+    # Returns: The list of ids of the threads on website that belong to this
+    #          post.
+    def thread_ids(self, website):
+        thread_ids = self.other_ids.get(website, [])
+        if type(thread_ids) != type([]):
+            thread_ids = [ thread_ids ]
+        return thread_ids
+
+# The posts that we sync, in order, indexed by their Disqus id and by every
+# source thread that they copy comments from.
+class PostIndex:
+    def __init__(self, posts=[]):
+        self.posts = []
+        self.by_disqus_id = {}
+        self.by_thread = {}
+        for post in posts:
+            self.add(post)
+
+    # Adds post to the end of the index.
+    # Raises a ValueError if a post with the same Disqus id, or a post that
+    # copies from one of the same threads, is already in the index.
+    def add(self, post):
+        if post.disqus_id in self.by_disqus_id:
+            raise ValueError('Post %s appears more than once' % post.disqus_id)
+        for website in post.other_ids:
+            for thread_id in post.thread_ids(website):
+                other = self.by_thread.get((website, thread_id))
+                if other is not None:
+                    raise ValueError('Posts %s and %s both copy comments from %s on %s' % (other.disqus_id, post.disqus_id, thread_id, website))
+                self.by_thread[(website, thread_id)] = post
+        self.posts.append(post)
+        self.by_disqus_id[post.disqus_id] = post
+
+    # Returns: The post with the given Disqus id, or None.
+    def get(self, disqus_id):
+        return self.by_disqus_id.get(disqus_id)
+
+    # Returns: The post that copies comments from thread_id on website, or
+    #          None.
+    def find_thread(self, website, thread_id):
+        return self.by_thread.get((website, thread_id))
+
+    def __iter__(self):
+        return iter(self.posts)
+
+    def __len__(self):
+        return len(self.posts)
         
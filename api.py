@@ -1,21 +1,259 @@
-import requests
-import re
+import calendar, hashlib, json, math, re, sys, threading, time
 from config import *
 from keys import *
 from adts import *
-from urlparse import parse_qs
-from html import HTML
-
-import urllib2
-from bs4 import BeautifulSoup
-
-Request = requests.Request
+from metrics import metrics
+from urllib import urlencode
+from urlparse import parse_qs, urlparse
+from HTMLParser import HTMLParser
+# time.strptime imports this lazily, which can fail when it is first called
+# from several threads at once
+import _strptime
+
+# requests, bs4 (with lxml) and html take most of the time it takes to start
+# up, so they are only imported where they are used. Commands that never make
+# a request or scrape a page, or whose answer is cached, do not load them.
+
+unescape_html = HTMLParser().unescape
+
+# Keeps one pooled requests.Session per host, so that every API object reuses
+# the same kept-alive connections instead of opening a new TCP and TLS
+# connection for each request. Safe to share between threads.
+class Transport:
+    def __init__(self,
+                 pool_size=HTTP_POOL_SIZE,
+                 timeout=HTTP_TIMEOUT,
+                 retries=HTTP_RETRIES,
+                 backoff=HTTP_BACKOFF):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    # Returns: The requests.Session to use for url.
+    def session(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from requests.packages.urllib3.util.retry import Retry
+                # Only connection errors and gateway failures are retried
+                # here. Retry does not retry POSTs that reached the server,
+                # so this can never post a comment twice.
+                retry = Retry(total=self.retries,
+                              backoff_factor=self.backoff,
+                              status_forcelist=[500, 502, 503, 504])
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    # Makes a request with the same conventions as requests.get and
+    # requests.post: arguments are sent as query parameters for GET and as the
+    # form body for POST.
+    # endpoint: What to call the request in metrics; defaults to the host.
+    # Returns: The result of the request (an HTTPResponse object).
+    def request(self, request_type, url, arguments=None, headers=None, endpoint=None):
+        assert request_type in ['get', 'post']
+        session = self.session(url)
+        host = urlparse(url).netloc
+        endpoint = endpoint or host
+        status = 'error'
+        start = time.time()
+        try:
+            if request_type == 'get':
+                result = session.get(url, params=arguments, headers=headers, timeout=self.timeout)
+            else:
+                result = session.post(url, data=arguments, headers=headers, timeout=self.timeout)
+            status = result.status_code
+            metrics.count('response_bytes', len(result.content), host=host, endpoint=endpoint)
+            return result
+        finally:
+            labels = { 'host': host, 'endpoint': endpoint, 'status': status }
+            metrics.observe('request_seconds', time.time() - start, **labels)
+            metrics.count('requests', **labels)
+
+    def get(self, url, arguments=None, headers=None, endpoint=None):
+        return self.request('get', url, arguments, headers, endpoint)
+
+    def post(self, url, arguments=None, headers=None, endpoint=None):
+        return self.request('post', url, arguments, headers, endpoint)
+
+# Shared by every API object unless they are given their own Transport.
+shared_transport = Transport()
 
 class API:
-    def __init__(self, debug):
+    # Whether get_comments can be asked for only the comments made since a
+    # given timestamp
+    SUPPORTS_SINCE = False
+
+    def __init__(self, debug, transport=shared_transport):
         self.debug = debug
+        self.transport = transport
+
+# A token bucket that allows bursts of up to capacity requests and refills at
+# rate requests per second. The bucket can also be told about the quota the
+# server reports, so that we never send requests that are bound to be
+# rejected. Safe to share between threads.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Uses up one token if a request may be made now, without blocking.
+    # Returns: 0 if a token was used, or else how many seconds it will be
+    #          until one is available.
+    def try_acquire(self):
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            wait = self.blocked_until - now
+            if wait > 0:
+                return wait
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill(time.time())
+            self.rate = float(rate)
+
+    # Blocks until a request may be made, and then uses up one token.
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Adapts to the quota that the server reports.
+    # remaining: How many more requests the server will accept.
+    # reset: The unix time at which the server's quota resets.
+    def observe(self, remaining, reset):
+        with self.lock:
+            self.refill(time.time())
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0:
+                self.blocked_until = max(self.blocked_until, reset)
+
+    # Stops all requests through this bucket for delay seconds.
+    def backoff(self, delay):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + delay)
+
+# Keeps one TokenBucket per kind of credential, since the server counts
+# requests separately for each of them.
+# limits: A dictionary mapping each credential kind to a
+#         (requests per hour, burst size) pair.
+class RateLimiter:
+    def __init__(self, limits, max_retries, initial_backoff):
+        self.limits = limits
+        self.buckets = { k:TokenBucket(limits[k][0] / 3600.0, limits[k][1]) for k in limits }
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+
+    def bucket(self, key_type):
+        return self.buckets[key_type]
+
+    # Limits us to fraction of each quota, for when several processes share
+    # the same keys.
+    def set_share(self, fraction):
+        for key_type, bucket in self.buckets.items():
+            bucket.set_rate(self.limits[key_type][0] / 3600.0 * fraction)
+
+    # Returns: How many seconds it would take to make requests (a dictionary
+    # from key types to numbers of requests) at the allowed rates, if every
+    # bucket started out full and nothing else used them.
+    def drain_seconds(self, requests):
+        seconds = 0
+        for key_type, n in requests.items():
+            bucket = self.buckets[key_type]
+            seconds = max(seconds, max(0, n - bucket.capacity) / bucket.rate)
+        return seconds
+
+    # Makes a request through the bucket for key_type, retrying with
+    # exponential backoff while the server says we are rate limited.
+    # make_request: A function of no arguments that makes the request.
+    # Returns: The result of the last request (an HTTPResponse object).
+    def call(self, key_type, make_request):
+        bucket = self.bucket(key_type)
+        delay = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            result = make_request()
+            remaining = result.headers.get('X-Ratelimit-Remaining')
+            reset = result.headers.get('X-Ratelimit-Reset')
+            if remaining is not None and reset is not None:
+                bucket.observe(int(remaining), int(reset))
+            if result.status_code != 429:
+                break
+            wait = delay
+            if reset is not None:
+                wait = max(wait, int(reset) - time.time())
+            print 'Rate limited on the %s key, backing off for %.1f seconds' % (key_type, wait)
+            bucket.backoff(wait)
+            delay *= 2
+        return result
+
+# Runs function(*args) in a background thread.
+class Background(threading.Thread):
+    def __init__(self, function, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+
+    # Waits for the function to finish.
+    # Returns: What the function returned. If it raised an exception, the
+    #          exception is raised again here instead.
+    def result(self):
+        # Joining in short steps keeps Ctrl-C working while we wait
+        while self.is_alive():
+            self.join(1)
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+# Shared by every DisqusAPI object, so that the quota is tracked across them.
+disqus_rate_limiter = RateLimiter(DISQUS_RATE_LIMITS, DISQUS_MAX_RETRIES, DISQUS_INITIAL_BACKOFF)
 
 class DisqusAPI(API):
+    # Matches the link that create_message puts at the start of a comment
+    SYNCED_FROM = re.compile('Synced from <a ([^>]*)>([^<]*)</a>')
+    ATTRIBUTE = re.compile('([a-z]+)="([^"]*)"')
+
     def __init__(self,
                  debug,
                  global_key=DISQUS_GLOBAL_KEY,
@@ -24,8 +262,16 @@ class DisqusAPI(API):
                  forum_name=DISQUS_FORUM_NAME,
                  owner_access_token=DISQUS_OWNER_ACCESS_TOKEN,
                  admin_access_token=DISQUS_ADMIN_ACCESS_TOKEN,
-                 limit=100):
-        API.__init__(self, debug)
+                 limit=100,
+                 prefetch=DISQUS_PREFETCH,
+                 rate_limiter=disqus_rate_limiter,
+                 transport=shared_transport,
+                 api_url=DISQUS_API_URL,
+                 response_cache=None):
+        API.__init__(self, debug, transport)
+        self.api_url = api_url
+        # If given, a ResponseCache for the answers of the listing methods
+        self.response_cache = response_cache
         self.global_key = global_key
         self.app_key = app_key
         self.app_secret = app_secret
@@ -33,6 +279,30 @@ class DisqusAPI(API):
         self.owner_access_token = owner_access_token
         self.admin_access_token = admin_access_token
         self.limit = limit
+        self.prefetch = prefetch
+        self.rate_limiter = rate_limiter
+        # If set by defer_approvals, guest comments are approved in batches
+        self.approval_queue = None
+
+    # Makes make_comment queue guest comments for approval instead of
+    # approving each one right away. Call flush_approvals to approve whatever
+    # is still queued.
+    # journal: A Store to keep the queue in, so that it survives a crash.
+    # site: The name of the site whose forum this is, to tell its queue apart
+    #       from those of other sites in journal.
+    def defer_approvals(self, journal, batch_size=APPROVE_BATCH_SIZE, site=DEFAULT_SITE):
+        self.approval_queue = ApprovalQueue(self, journal, batch_size, site)
+
+    def flush_approvals(self):
+        if self.approval_queue is not None:
+            self.approval_queue.flush()
+
+    # Returns: Which credential the request is counted against by Disqus, one
+    # of the keys of DISQUS_RATE_LIMITS.
+    def key_type(self, options):
+        if 'access_token' in options:
+            return 'admin'
+        return 'global' if 'useGlobal' in options else 'app'
 
     # Implements the options taken by get and post by mutating the arguments
     # dictionary.
@@ -53,6 +323,8 @@ class DisqusAPI(API):
     # endPoint: A string identifier for the Disqus API function to invoke.
     # arguments: Query parameters for the endpoint.
     # options: Various options that customize how the request is made.
+    # Requests are throttled by self.rate_limiter, so this may block until the
+    # quota for the relevant key allows another request.
     # Returns: The result of the request (an HTTPResponse object).
     def request(self, request_type, endPoint, arguments={}, options=[]):
         assert request_type in ['get', 'post']
@@ -61,16 +333,16 @@ class DisqusAPI(API):
         arguments = { k:arguments[k] for k in arguments }
         self.fix_arguments(arguments, options)
 
-        url = 'https://disqus.com/api/3.0/' + endPoint
-        fn = requests.get if request_type == 'get' else requests.post
-        result = fn(url, arguments)
+        url = self.api_url + endPoint
+        make_request = lambda: self.transport.request(request_type, url, arguments, endpoint=endPoint)
+        result = self.rate_limiter.call(self.key_type(options), make_request)
         if result.status_code != 200:
             print result.text
         return result
 
     # Makes a GET request to the Disqus API with the given parameters.
     def get(self, endPoint, arguments={}, options=[]):
-        return self.request('get', endpoint, arguments, options)
+        return self.request('get', endPoint, arguments, options)
 
     # Makes a POST request to the Disqus API with the given parameters.
     def post(self, endPoint, arguments={}, options=[]):
@@ -79,32 +351,101 @@ class DisqusAPI(API):
             return
         # We always allow a POST request to not specify a limit.
         if 'limit' not in arguments and 'noLimit' not in options:
-            options.append('noLimit')
-        return self.request('post', endpoint, arguments, options)
-
+            options = options + ['noLimit']
+        return self.request('post', endPoint, arguments, options)
+
+    # Gets one page of a Disqus list endpoint. Raises ValueError if Disqus
+    # answers with an error (including a 429 left over when the RateLimiter
+    # runs out of retries), whose response is a message rather than a list.
+    # endPoint, arguments, options: As for get.
+    # Returns: The page (as a dictionary).
+    def get_page(self, endPoint, arguments, options):
+        result = self.get(endPoint, arguments, options)
+        page = result.json() if result.status_code == 200 else None
+        if page is None or page.get('code') != 0:
+            raise ValueError('Disqus request to %s failed with status %d: %s' % (endPoint, result.status_code, result.text))
+        return page
+
+    # Yields every item of a Disqus list endpoint, following the cursor from
+    # page to page. Only the current page is kept in memory, plus the next
+    # one, which is fetched in the background while the current one is being
+    # consumed if self.prefetch is set.
+    # endPoint, arguments, options: As for get.
+    # Returns: A generator of items (as dictionaries).
+    def list_all(self, endPoint, arguments={}, options=[]):
+        arguments = { k:arguments[k] for k in arguments }
+        fetch = lambda arguments: self.get_page(endPoint, arguments, options)
+        page = fetch(arguments)
+        while True:
+            cursor = page.get('cursor') or {}
+            next_page = None
+            if cursor.get('hasNext'):
+                arguments = dict(arguments, cursor=cursor['next'])
+                if self.prefetch:
+                    next_page = Background(fetch, arguments)
+            for item in page['response']:
+                yield item
+            if not cursor.get('hasNext'):
+                return
+            page = next_page.result() if next_page is not None else fetch(arguments)
+
+    # Yields every comment on a thread, oldest first. Comments still waiting
+    # for approval are included.
     # thread: Id of the post to get comments for (as a string).
-    # Returns: The result of the request (an HTTPResponse object).
-    # Calling JSON on the response will have the required data.
-    def get_comments_on_thread(self, thread):
-        return self.get('threads/listPosts.json', {'thread': thread})
+    # since: If given, only comments made at or after this time are listed.
+    #        This is a string in the same format as a comment's createdAt.
+    # Returns: A generator of comments (as dictionaries).
+    def get_comments_on_thread(self, thread, since=None):
+        arguments = {
+            'thread': thread,
+            'order': 'asc',
+            'include': ['approved', 'unapproved']
+        }
+        if since is not None:
+            arguments['since'] = since
+        return self.list_all('threads/listPosts.json', arguments, ['access_token'])
 
-    # Returns: The result of the request (an HTTPResponse object).
-    # Calling JSON on the response will have the required data.
+    # Returns: A generator of every post on the forum (as dictionaries).
     def get_posts(self):
-        return self.get('forums/listThreads.json')
+        return self.list_all('forums/listThreads.json')
 
+    # Returns: A generator of (id, title) pairs for every post on the forum.
+    # With a response_cache, a recent answer is used without asking Disqus.
     def get_post_ids_and_titles(self):
-        result = self.get_posts().json()['response']
-        return [(post['id'], post['clean_title']) for post in result]
+        if self.response_cache is None:
+            return ((post['id'], post['clean_title']) for post in self.get_posts())
+        compute = lambda: [(post['id'], post['clean_title']) for post in self.get_posts()]
+        return iter(self.response_cache.get(('disqus-ids', self.api_url, self.forum_name), compute))
 
     # Converts a RealComment into HTML suitable for posting to Disqus.
     # comment: The RealComment object to construct a message from.
     # Returns: Stringified HTML for the comment text.
     def create_message(self, comment):
+        from html import HTML
         atag = HTML().a(comment.website, href=comment.url)
         source = HTML().p('Synced from ' + str(atag), escape=False)
         return str(source) + comment.content
 
+    # Finds the link that create_message put at the start of a comment.
+    # message: The HTML of a comment, as returned by Disqus.
+    # Returns: A (website, url) pair saying where the comment was copied from,
+    #          or None if it wasn't copied by us.
+    def parse_synced_from(self, message):
+        match = self.SYNCED_FROM.search(message)
+        if match is None:
+            return None
+        attributes = dict(self.ATTRIBUTE.findall(match.group(1)))
+        # Disqus wraps links in a redirect, but keeps the real url in the title
+        url = attributes.get('title') or attributes.get('href')
+        if url is None:
+            return None
+        url = unescape_html(url)
+        if urlparse(url).netloc == 'disq.us':
+            url = parse_qs(urlparse(url).query)['url'][0]
+            # The redirect adds ':' and a hash to the end of the url
+            url = re.sub(':[A-Za-z0-9_-]+$', '', url)
+        return (unescape_html(match.group(2)).strip(), url)
+
     def guarded_make_comment(self, comment, thread, parent=None):
         if '[nocopy]' in comment.content:
             comment.content = '<p><i>Comment hidden by request</i></p>'
@@ -118,26 +459,54 @@ class DisqusAPI(API):
     # thread: The id of the parent comment that this is a reply to, or the id of
     # the blog post if it is a top-level comment. This is a string.
     # Returns: The Disqus ID of the created comment.
+    @metrics.timed('make_comment_seconds')
     def make_comment(self, comment, thread, parent=None):
         message = self.create_message(comment)
         if comment.is_owner_comment:
             print 'Adding owner comment from', comment.website
             if self.debug:
-                print 'Not adding owner comment since we are in debug mode'
-                return 0
+                print 'Not adding owner comment since we are in debug mode' + self.debug_reply(parent)
+                return self.debug_id(comment)
             req = self.add_owner_comment(message, thread, parent)
             return req.json()['response']['id']
         else:
             name = comment.username.strip().split()[0]
             print 'Add comment by', name, 'from', comment.website
             if self.debug:
-                print 'Not adding comment since we are in debug mode'
-                return 0
+                print 'Not adding comment since we are in debug mode' + self.debug_reply(parent)
+                return self.debug_id(comment)
             req = self.add_comment(name, message, thread, parent)
             comment_id = req.json()['response']['id']
-            self.approve_comment(comment_id)
+            if self.approval_queue is not None:
+                self.approval_queue.add(comment_id)
+            else:
+                self.approve_comment(comment_id)
             return comment_id
 
+    # Returns: What make_comment gives as the Disqus id of comment in debug
+    # mode, when it is not created. Replies to it are then shown as replies to
+    # this id, rather than to a made up comment.
+    def debug_id(self, comment):
+        return 'debug:%s:%s' % (comment.website, comment.id)
+
+    def debug_reply(self, parent):
+        return ' (as a reply to %s)' % parent if parent else ''
+
+    # Returns: How many requests copying that many owner and guest comments
+    # would make with each credential, as a dictionary with the keys of
+    # DISQUS_RATE_LIMITS. Approvals of comments that are already queued for
+    # approval are included.
+    def estimate_requests(self, owner, guest):
+        requests = dict.fromkeys(self.rate_limiter.limits, 0)
+        requests[self.key_type(['access_token'])] += owner
+        requests[self.key_type(['useGlobal'])] += guest
+        if self.approval_queue is not None:
+            approvals = guest + len(self.approval_queue.pending)
+            requests[self.key_type(['access_token'])] += int(math.ceil(approvals / float(self.approval_queue.batch_size)))
+        else:
+            requests[self.key_type(['access_token'])] += guest
+        return requests
+
     # Adds a comment as a reply to the entity identified by thread.
     # By default, this is a guest comment and so is subject to moderation.
     # name: The author of the comment, as a plain text string.
@@ -170,13 +539,21 @@ class DisqusAPI(API):
     # comment_id: The id of the comment to approve, as a string.
     # Returns: The result of the request (an HTTPResponse object).
     def approve_comment(self, comment_id):
+        return self.approve_comments([comment_id])
+
+    # Approves several comments with a single request.
+    # comment_ids: A list of the ids of the comments to approve, as strings.
+    # Returns: The result of the request (an HTTPResponse object).
+    @metrics.timed('approve_seconds')
+    def approve_comments(self, comment_ids):
         return self.post('posts/approve.json',
-                         { 'post': comment_id },
+                         { 'post': comment_ids },
                          ['access_token', 'noForum'])
 
     # Returns: An access token for Disqus, as a string.
     # Involves some user interaction.
     def get_access_token(self):
+        from requests import Request
         redirect = 'http://rohinshah.com/'
         oreq = Request('GET', "https://disqus.com/api/oauth/2.0/authorize",
                        params = {
@@ -191,26 +568,86 @@ class DisqusAPI(API):
         result = raw_input("> ")
         code = re.findall('code=(.*)$', result)[0]
 
-        r = requests.post('https://disqus.com/api/oauth/2.0/access_token/',
-                          {
-                              'grant_type': 'authorization_code',
-                              'client_id': self.app_key,
-                              'client_secret': self.app_secret,
-                              'redirect_uri': redirect,
-                              'code': code
-                          })
+        r = self.transport.post('https://disqus.com/api/oauth/2.0/access_token/',
+                                {
+                                    'grant_type': 'authorization_code',
+                                    'client_id': self.app_key,
+                                    'client_secret': self.app_secret,
+                                    'redirect_uri': redirect,
+                                    'code': code
+                                })
 
         return r.json()['access_token']
 
 
+# Guest comments that have been posted to Disqus but not yet approved. They are
+# approved batch_size at a time, with one request per batch. Every id is
+# written to journal before it is queued and removed once it is approved, so
+# the ids that were still queued when we crashed are approved on the next run.
+# Safe to share between threads.
+class ApprovalQueue:
+    def __init__(self, disqus_api, journal, batch_size, site=DEFAULT_SITE):
+        self.disqus_api = disqus_api
+        self.journal = journal
+        self.batch_size = batch_size
+        self.site = site
+        self.lock = threading.Lock()
+        self.pending = journal.load_pending_approvals(site)
+
+    def add(self, comment_id):
+        with self.lock:
+            self.journal.add_pending_approval(comment_id, self.site)
+            self.pending.append(comment_id)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            # The comment has been created, so a failed approval must not
+            # make it look as if it had not been
+            try:
+                self.flush()
+            except Exception as e:
+                print 'Failed to approve comments, leaving them queued:', e
+
+    # Approves every queued comment. Comments whose approval fails stay queued,
+    # and so do the ones after it if a request raises an error.
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        failed = []
+        # How many of pending have been dealt with
+        done = 0
+        try:
+            for i in range(0, len(pending), self.batch_size):
+                batch = pending[i:i + self.batch_size]
+                print 'Approving', len(batch), 'comments'
+                result = self.disqus_api.approve_comments(batch)
+                if result is not None and result.status_code == 200:
+                    self.journal.remove_pending_approvals(batch)
+                else:
+                    failed.extend(batch)
+                done = i + len(batch)
+        finally:
+            with self.lock:
+                self.pending = failed + pending[done:] + self.pending
+
 class FacebookAPI(API):
+    # The fields of a comment that make_comment_object needs
+    COMMENT_FIELDS = 'id,from,message,created_time'
+    SUPPORTS_SINCE = True
+
     def __init__(self,
                  debug,
                  app_id=FB_APP_ID,
                  app_secret=FB_APP_SECRET,
                  user_id=FB_OWNER_ID,
-                 access_token=FB_LONG_CODE):
-        API.__init__(self, debug)
+                 access_token=FB_LONG_CODE,
+                 transport=shared_transport,
+                 graph_url=FACEBOOK_GRAPH_URL,
+                 response_cache=None):
+        API.__init__(self, debug, transport)
+        self.graph_url = graph_url
+        # If given, a ResponseCache for the answer of get_posts
+        self.response_cache = response_cache
         self.app_id = app_id
         self.app_secret = app_secret
         self.user_id = user_id
@@ -218,12 +655,14 @@ class FacebookAPI(API):
 
     def request(self, request_type, endpoint, arguments, options):
         assert request_type in ['get', 'post']
-        fn = requests.get if request_type == 'get' else requests.post
-        url = 'https://graph.facebook.com/v2.8/' + endpoint
+        url = self.graph_url + endpoint
         arguments = { k:arguments[k] for k in arguments }
         if 'no_access_token' not in options:
             arguments['access_token'] = self.access_token
-        return fn(url, arguments)
+        # Object ids are left out of the endpoint name used for metrics
+        name = '/'.join('{id}' if re.match('[0-9_]+$', part) else part
+                        for part in endpoint.split('/')) or 'batch'
+        return self.transport.request(request_type, url, arguments, endpoint=name)
 
     def get(self, endpoint, arguments={}, options=[]):
         return self.request('get', endpoint, arguments, options)
@@ -231,27 +670,136 @@ class FacebookAPI(API):
     def post(self, endpoint, arguments={}, options=[]):
         return self.request('post', endpoint, arguments, options)
 
+    # Returns: The owner's posts (as dictionaries). With a response_cache, a
+    # recent answer is used without asking Facebook.
     def get_posts(self):
-        return self.get('me/posts').json()['data']
+        compute = lambda: self.get('me/posts').json()['data']
+        if self.response_cache is None:
+            return compute()
+        return self.response_cache.get(('fb-posts', self.graph_url, self.user_id), compute)
+
+    # Returns: The id of the comment that make_comment_object gave url to.
+    def comment_id_from_url(self, url):
+        return url[len('https://www.facebook.com/'):]
 
     def make_comment_object(self, post_id, data):
         url = 'https://www.facebook.com/' + data['id']
         is_owner = data['from']['id'] == self.user_id
-        return RealComment(FACEBOOK_STRING, post_id, data['id'], url, data['from']['name'], is_owner, data['message'])
+        return RealComment(FACEBOOK_STRING, post_id, data['id'], url, data['from']['name'], is_owner, data['message'], data.get('created_time'))
+
+    # page: One page of results from a Facebook edge (as a dictionary).
+    # Returns: The cursor for the next page, or None if this is the last page.
+    def next_cursor(self, page):
+        paging = page.get('paging', {})
+        if 'next' not in paging or 'cursors' not in paging:
+            return None
+        return paging['cursors']['after']
 
     # object_id: The id of a Facebook node that has the comments edge
-    # Returns: A list of Facebook comments (as dictionaries)
-    def get_one_level_comments(self, object_id):
-        result = self.get(object_id + '/comments').json()
-        return result['data']
+    # arguments: Extra query parameters for the comments edge.
+    # Returns: A list of Facebook comments (as dictionaries), from all pages.
+    def get_one_level_comments(self, object_id, arguments={}):
+        arguments = { k:arguments[k] for k in arguments }
+        arguments.setdefault('limit', FB_PAGE_LIMIT)
+        comments = []
+        while True:
+            result = self.get(object_id + '/comments', arguments).json()
+            comments.extend(result['data'])
+            cursor = self.next_cursor(result)
+            if cursor is None:
+                return comments
+            arguments['after'] = cursor
+
+    # Fetches the rest of the replies for comments whose replies did not all
+    # fit on the first page, using Graph batch requests so that up to
+    # FB_BATCH_SIZE comments are handled by each request.
+    # cursors: A dictionary mapping comment ids to the cursor for the next
+    #          page of their replies.
+    # replies: A dictionary mapping comment ids to the list of replies fetched
+    #          so far. New replies are appended to it.
+    def get_remaining_replies(self, cursors, replies):
+        while cursors:
+            comment_ids = sorted(cursors)[:FB_BATCH_SIZE]
+            batch = []
+            for comment_id in comment_ids:
+                query = urlencode({
+                    'fields': self.COMMENT_FIELDS,
+                    'limit': FB_PAGE_LIMIT,
+                    'after': cursors.pop(comment_id)
+                })
+                batch.append({ 'method': 'GET', 'relative_url': comment_id + '/comments?' + query })
+
+            results = self.post('', { 'batch': json.dumps(batch) }).json()
+            for comment_id, result in zip(comment_ids, results):
+                if result is None or result['code'] != 200:
+                    raise ValueError('Facebook batch request for replies to %s failed: %s' % (comment_id, result))
+                page = json.loads(result['body'])
+                replies[comment_id].extend(page['data'])
+                cursor = self.next_cursor(page)
+                if cursor is not None:
+                    cursors[comment_id] = cursor
+
+    # timestamp: A Facebook created_time, like 2017-09-26T17:03:12+0000.
+    # Returns: The timestamp as seconds since the epoch.
+    def to_unix_time(self, timestamp):
+        return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+    # Gets the comments on a post made since the given time. This uses the
+    # flat stream of all comments, so that new replies to old comments are
+    # found too.
+    # post_id: The id of the Facebook post.
+    # since: A Facebook created_time. Comments from up to FB_SINCE_OVERLAP
+    #        seconds before it are fetched as well, in case they showed up late.
+    # Returns: A Tree containing the new RealComments. Replies to comments that
+    #          are not new are placed under a CommentPointer to that comment.
+    def get_new_comments(self, post_id, since):
+        arguments = {
+            'fields': self.COMMENT_FIELDS + ',parent{id}',
+            'filter': 'stream',
+            'order': 'chronological',
+            'since': self.to_unix_time(since) - FB_SINCE_OVERLAP
+        }
+        root = Tree(None)
+        for comment_dict in self.get_one_level_comments(post_id, arguments):
+            parent_node = root
+            if 'parent' in comment_dict:
+                parent_id = comment_dict['parent']['id']
+                parent_node = root.find(parent_id)
+                if parent_node is None:
+                    pointer = CommentPointer(FACEBOOK_STRING, post_id, parent_id)
+                    parent_node = root.add_child(pointer)
+            parent_node.add_child(self.make_comment_object(post_id, comment_dict))
+        return root
+
+    # Gets the whole comment tree of a post. The replies to each comment are
+    # expanded in the same request as the comments themselves, so a post
+    # usually needs a single request, plus one per page of FB_PAGE_LIMIT
+    # comments on busy posts.
+    # post_id: The id of the Facebook post.
+    # since: If given, only the comments made since then are fetched, as by
+    #        get_new_comments.
+    # Returns: A Tree containing RealComments for the post.
+    def get_comments(self, post_id, since=None):
+        if since is not None:
+            return self.get_new_comments(post_id, since)
+        fields = '%s,comments.limit(%d){%s}' % (self.COMMENT_FIELDS, FB_PAGE_LIMIT, self.COMMENT_FIELDS)
+        top_level = self.get_one_level_comments(post_id, { 'fields': fields })
+
+        replies = {}
+        cursors = {}
+        for comment_dict in top_level:
+            reply_page = comment_dict.get('comments', { 'data': [] })
+            replies[comment_dict['id']] = reply_page['data']
+            cursor = self.next_cursor(reply_page)
+            if cursor is not None:
+                cursors[comment_dict['id']] = cursor
+        self.get_remaining_replies(cursors, replies)
 
-    def get_comments(self, post_id):
-        top_level = self.get_one_level_comments(post_id)
         root = Tree(None)
         for comment_dict in top_level:
             comment_obj = self.make_comment_object(post_id, comment_dict)
             comment_tree_node = root.add_child(comment_obj)
-            for reply_dict in self.get_one_level_comments(comment_dict['id']):
+            for reply_dict in replies[comment_dict['id']]:
                 reply_obj = self.make_comment_object(post_id, reply_dict)
                 comment_tree_node.add_child(reply_obj)
         return root
@@ -259,6 +807,7 @@ class FacebookAPI(API):
     # Returns: A long-term access token for Facebook as a string.
     # Involves some user interaction.
     def get_access_token(self):
+        from requests import Request
         redirect = 'http://rohinshah.com/'
         oreq = Request('GET', "https://www.facebook.com/dialog/oauth",
                        params = {
@@ -276,43 +825,65 @@ class FacebookAPI(API):
             return response.json()['access_token']
     
         short_code = get_code(
-            requests.get('https://graph.facebook.com/oauth/access_token',
-                         {
-                             'client_id': self.app_id,
-                             'redirect_uri': redirect,
-                             'client_secret': self.app_secret,
-                             'code': code
-                         }))
+            self.transport.get('https://graph.facebook.com/oauth/access_token',
+                               {
+                                   'client_id': self.app_id,
+                                   'redirect_uri': redirect,
+                                   'client_secret': self.app_secret,
+                                   'code': code
+                               }))
 
         return get_code(
-            requests.get('https://graph.facebook.com/oauth/access_token',
-                         {
-                             'client_id': self.app_id,
-                             'client_secret': self.app_secret,
-                             'grant_type': 'fb_exchange_token',
-                             'fb_exchange_token': short_code
-                         }))
+            self.transport.get('https://graph.facebook.com/oauth/access_token',
+                               {
+                                   'client_id': self.app_id,
+                                   'client_secret': self.app_secret,
+                                   'grant_type': 'fb_exchange_token',
+                                   'fb_exchange_token': short_code
+                               }))
 
 class EAForumAPI(API):
     DIV_START = '<div class="md">'
     DIV_END = '</div>'
-    def __init__(self, debug):
-        API.__init__(self, debug)
+    COMMENTS_MARKER = 'id="comments"'
+    # The classes of the elements inside a comment that we scrape
+    ENTRY_CLASSES = ['comment-author', 'comment-content', 'parent']
+
+    # cache: A PageCache to keep scraped pages in, or None to always download
+    #        and parse every page.
+    # owner: The EA Forum username of the blog's author, whose comments are
+    #        copied as owner comments.
+    def __init__(self, debug, transport=shared_transport, cache=None, owner=EA_FORUM_OWNER):
+        API.__init__(self, debug, transport)
+        self.cache = cache
+        self.owner = owner
+
+    # Returns: The id of the comment that make_comment_object gave url to.
+    def comment_id_from_url(self, url):
+        return url[url.rindex('#') + 1:]
 
     # url: The url of the EA Forum post that the comment comes from
     # commentDiv: The BeautifulSoup div representing the comment
     #             (This is the one with class "entry".)
+    # anchor: The closest element with class "parent" before commentDiv, which
+    #         holds the id of the comment. Searched for if not given.
+    # parts: The result of find_first_with_class(commentDiv, ENTRY_CLASSES).
+    #        Computed if not given.
     # Returns: A Comment object. Tries to make a RealComment object by scraping
     #          relevant information, if this is not possible it returns a
     #          FakeComment that keeps the information to be used later.
-    def make_comment_object(self, url, commentDiv):
+    def make_comment_object(self, url, commentDiv, anchor=None, parts=None):
         try:
-            id = unicode(commentDiv.findPrevious(class_='parent').a['name'])
+            if anchor is None:
+                anchor = commentDiv.findPrevious(class_='parent')
+            if parts is None:
+                parts = self.find_first_with_class(commentDiv, self.ENTRY_CLASSES)
+            id = unicode(anchor.a['name'])
             separator = '#' if url[-1] == '/' else '/#'
             comment_url = url + separator + id
-            author = unicode(commentDiv.find(class_='comment-author').a.text)
-            is_owner = (author == 'rohinmshah')
-            contentDiv = commentDiv.find(class_='comment-content')
+            author = unicode(parts['comment-author'].a.text)
+            is_owner = (author == self.owner)
+            contentDiv = parts['comment-content']
             msg = unicode(contentDiv.find(class_='md')).strip()
             if msg.startswith(self.DIV_START) and msg.endswith(self.DIV_END):
                 msg = msg[len(self.DIV_START):-len(self.DIV_END)].strip()
@@ -322,29 +893,98 @@ class EAForumAPI(API):
         except (KeyError, AttributeError, TypeError) as e:
             return FakeComment((url, commentDiv))
 
+    # Does the same as calling element.find(class_=c) for each c in classes,
+    # but looks at each element under element only once.
+    # Returns: A dictionary mapping each class in classes to the first element
+    #          under element that has that class, or None if there is none.
+    def find_first_with_class(self, element, classes):
+        from bs4 import Tag
+        found = dict.fromkeys(classes)
+        missing = len(classes)
+        for descendant in element.descendants:
+            if not isinstance(descendant, Tag):
+                continue
+            for c in descendant.get('class', ()):
+                if c in found and found[c] is None:
+                    found[c] = descendant
+                    missing -= 1
+            if missing == 0:
+                break
+        return found
+
     # url: A url pointing to an EA Forum post.
     # Returns a Tree containing RealComments scraped from the post.
+    # If there is a cache, pages that have not changed since they were last
+    # scraped are not downloaded again, and pages whose comments have not
+    # changed are not parsed again.
     def get_comments(self, url):
-        page = urllib2.urlopen(url)
-        soup = BeautifulSoup(page, "lxml")
-        comments = soup.find(id='comments').find_all(class_='entry')
+        if self.cache is None:
+            page = self.transport.get(url)
+            page.raise_for_status()
+            return self.parse_comments(url, page.content)
+
+        # Which comments are owner comments depends on self.owner, which can
+        # differ between the sites sharing the cache
+        key = (url, self.owner)
+        entry = self.cache.load(key)
+        page = self.transport.get(url, headers=self.cache.conditional_headers(entry))
+        if page.status_code == 304 and entry is not None:
+            self.cache.count('not_modified')
+            self.cache.count('bytes_saved', entry['size'])
+            return entry['result']
+        page.raise_for_status()
+        self.cache.count('bytes_downloaded', len(page.content))
+
+        # Everything before the comments (the post itself, the sidebar and so
+        # on) doesn't affect the result.
+        start = page.content.find(self.COMMENTS_MARKER)
+        digest = hashlib.sha1(page.content[max(start, 0):]).hexdigest()
+        if entry is not None and entry['digest'] == digest:
+            self.cache.count('unchanged')
+            root = entry['result']
+        else:
+            self.cache.count('changed')
+            root = self.parse_comments(url, page.content)
+        self.cache.save(key, page, digest, root)
+        return root
+
+    # url: The url of the EA Forum post that the page comes from.
+    # content: The HTML of the page.
+    # Returns a Tree containing RealComments scraped from the page.
+    # Only the #comments element is parsed, and it is walked once, in document
+    # order, so the work is linear in the size of the comments.
+    def parse_comments(self, url, content):
+        from bs4 import BeautifulSoup, SoupStrainer, Tag
+        soup = BeautifulSoup(content, "lxml", parse_only=SoupStrainer(id='comments'))
         root = Tree(None)
-        id_to_node = {}
         unhandled = []
-        for commentDiv in comments:
-            comment = self.make_comment_object(url, commentDiv)
-            if not isinstance(comment, RealComment):
-                unhandled.append(comment)
+        # The closest element with class "parent" seen so far. When we reach a
+        # comment, this is the element that make_comment_object would
+        # otherwise have to search backwards through the document for.
+        anchor = None
+        for element in soup.find(id='comments').descendants:
+            if not isinstance(element, Tag):
                 continue
-
-            parent_node = root
-            parentDiv = commentDiv.find(class_='parent')
-            if parentDiv:
-                parent_id = parentDiv.a['href'][1:]
-                parent_node = id_to_node[parent_id]
-
-            new_node = parent_node.add_child(comment)
-            id_to_node[comment.id] = new_node
+            classes = element.get('class', ())
+            if 'entry' in classes:
+                commentDiv = element
+                parts = self.find_first_with_class(commentDiv, self.ENTRY_CLASSES)
+                comment = self.make_comment_object(url, commentDiv, anchor, parts)
+                if not isinstance(comment, RealComment):
+                    unhandled.append(comment)
+                else:
+                    parent_node = root
+                    parentDiv = parts['parent']
+                    if parentDiv:
+                        parent_id = parentDiv.a['href'][1:]
+                        parent_node = root.index[parent_id]
+
+                    parent_node.add_child(comment)
+            if 'parent' in classes:
+                anchor = element
 
         # TODO: Do something with unhandled
+        # The comments only hold copies of strings from the page, so the
+        # document can be freed right away.
+        soup.decompose()
         return root
@@ -0,0 +1,135 @@
+import argparse, os, random, resource, subprocess, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Compares EAForumAPI.parse_comments against the parser it replaced, on saved
+# EA Forum pages or on generated ones. Each parser runs in its own process so
+# that peak memory can be measured separately.
+#
+#   python benchmarks/parse_ea_forum.py page1.html page2.html
+#   python benchmarks/parse_ea_forum.py --synthetic 2000
+
+URL = 'http://effective-altruism.com/ea/154/thoughts_on_the_meta_trap/'
+
+# The parser before it was restricted to the #comments element: it parses the
+# whole page, searches backwards from every comment for its id, and makes a
+# separate search for each part of a comment.
+def legacy_parse(api, url, content):
+    from bs4 import BeautifulSoup
+    from adts import Tree, RealComment, FakeComment
+    from config import EA_FORUM_STRING
+
+    def make_comment_object(url, commentDiv):
+        try:
+            id = unicode(commentDiv.findPrevious(class_='parent').a['name'])
+            separator = '#' if url[-1] == '/' else '/#'
+            comment_url = url + separator + id
+            author = unicode(commentDiv.find(class_='comment-author').a.text)
+            is_owner = (author == 'rohinmshah')
+            contentDiv = commentDiv.find(class_='comment-content')
+            msg = unicode(contentDiv.find(class_='md')).strip()
+            if msg.startswith(api.DIV_START) and msg.endswith(api.DIV_END):
+                msg = msg[len(api.DIV_START):-len(api.DIV_END)].strip()
+            msg = msg.replace('<ul>', '<p>').replace('</ul>', '</p>')
+            msg = msg.replace('<li>', '* ').replace('</li>', '')
+            return RealComment(EA_FORUM_STRING, url, id, comment_url, author, is_owner, msg)
+        except (KeyError, AttributeError, TypeError) as e:
+            return FakeComment((url, commentDiv))
+
+    soup = BeautifulSoup(content, "lxml")
+    comments = soup.find(id='comments').find_all(class_='entry')
+    root = Tree(None)
+    id_to_node = {}
+    for commentDiv in comments:
+        comment = make_comment_object(url, commentDiv)
+        if not isinstance(comment, RealComment):
+            continue
+        parent_node = root
+        parentDiv = commentDiv.find(class_='parent')
+        if parentDiv:
+            parent_node = id_to_node[parentDiv.a['href'][1:]]
+        id_to_node[comment.id] = parent_node.add_child(comment)
+    return root
+
+# Returns: The comments of the tree in pre-order, as tuples of their
+# attributes and the id of their parent.
+def flatten(root):
+    result = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.item is not None:
+            c = node.item
+            parent = node.parent.item.id if node.parent.item is not None else None
+            result.append((c.website, c.post, c.id, c.url, c.username,
+                           c.is_owner_comment, c.content, parent))
+        stack.extend(reversed(node.children))
+    return result
+
+# Parses the page at path with the given parser, in this process.
+# Prints the time taken, the peak RSS in kilobytes and the parsed comments.
+def run(parser, path):
+    from sync import install_fake_keys
+    install_fake_keys()
+    from api import EAForumAPI
+    api = EAForumAPI(False)
+    with open(path) as f:
+        content = f.read()
+    comments = []
+    start = time.time()
+    if parser == 'legacy':
+        comments = flatten(legacy_parse(api, URL, content))
+    elif parser == 'current':
+        comments = flatten(api.parse_comments(URL, content))
+    elapsed = time.time() - start
+    print repr((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, comments))
+
+def measure(parser, path):
+    output = subprocess.check_output([sys.executable, __file__, '--run', parser, path])
+    return eval(output)
+
+def compare(path):
+    _, base_rss, _ = measure('none', path)
+    legacy_time, legacy_rss, legacy_comments = measure('legacy', path)
+    current_time, current_rss, current_comments = measure('current', path)
+    if legacy_comments != current_comments:
+        print '%s: MISMATCH, the parsers produced different comments' % path
+        return False
+    print '%s: %d comments, %d KB page' % (path, len(current_comments), os.path.getsize(path) / 1024)
+    print '  legacy:  %.3fs, %d KB peak' % (legacy_time, legacy_rss - base_rss)
+    print '  current: %.3fs, %d KB peak' % (current_time, current_rss - base_rss)
+    print '  speedup: %.1fx, memory: %.1fx less' % (
+        legacy_time / max(current_time, 1e-6),
+        float(legacy_rss - base_rss) / max(current_rss - base_rss, 1))
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the EA Forum comment parser.')
+    parser.add_argument('pages', nargs='*', help='Saved EA Forum post pages')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Also benchmark a generated page with this many comments')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='Maximum reply depth of the generated page')
+    parser.add_argument('--run', nargs=2, help=argparse.SUPPRESS)
+    params = parser.parse_args()
+
+    if params.run:
+        run(*params.run)
+        sys.exit(0)
+
+    pages = list(params.pages)
+    generated = None
+    if params.synthetic:
+        import tempfile
+        from synthetic import comment_tree, ea_forum_page
+        rng = random.Random(0)
+        handle, generated = tempfile.mkstemp(suffix='.html')
+        with os.fdopen(handle, 'w') as f:
+            f.write(ea_forum_page(rng, comment_tree(rng, params.synthetic, params.depth)))
+        pages.append(generated)
+
+    try:
+        ok = all([compare(path) for path in pages])
+    finally:
+        if generated is not None:
+            os.remove(generated)
+    sys.exit(0 if ok else 1)
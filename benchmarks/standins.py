@@ -0,0 +1,287 @@
+import argparse, hashlib, json, random, re, sys, threading, time
+import BaseHTTPServer, SocketServer
+from urlparse import parse_qs, urlparse
+from synthetic import comment_tree, ea_forum_page, sentence
+
+# A local HTTP server that stands in for the parts of Disqus, the Facebook
+# Graph API and the EA Forum that a sync uses, serving generated threads.
+# Everything is served from one host, under a prefix per website:
+#
+#   /disqus/   threads/listPosts.json, forums/listThreads.json,
+#              posts/create.json and posts/approve.json
+#   /graph/    {id}/comments, and batch requests posted to the root
+#   /ea/       /ea/{post}/ pages, with ETags
+#   /control/  grow, which adds comments to every post on both websites
+#
+# Post i (counting from 1) has Disqus id 'd{i}', EA Forum page /ea/{i}/ and
+# Facebook post id '{i}'. Run it on its own to print the port and serve until
+# killed:
+#
+#   python benchmarks/standins.py --posts 20 --comments 200
+
+# Facebook only allows replies to top level comments
+FACEBOOK_DEPTH = 2
+FACEBOOK_EPOCH = 1500000000
+FACEBOOK_OWNER_ID = 'owner'
+
+# The generated comments, and the comments posted to Disqus so far.
+# posts: How many posts there are.
+# comments: How many comments each post has on each website.
+# depth: How deeply EA Forum comments are nested.
+class World:
+    def __init__(self, posts, comments, depth, seed=0):
+        self.posts = posts
+        self.comments = comments
+        self.depth = depth
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.ea_pages = {}
+        self.facebook_comments = {}
+        # Disqus comments in the order they were created
+        self.disqus_comments = []
+        self.disqus_ids = 0
+
+    def rng(self, purpose, post):
+        return random.Random('%s %s %s' % (self.seed, purpose, post))
+
+    # Adds that many comments to every post on both websites. Existing
+    # comments keep their ids and places, since the shape of each thread is
+    # generated in the same order every time.
+    def grow(self, comments):
+        with self.lock:
+            self.comments += comments
+            self.ea_pages = {}
+            self.facebook_comments = {}
+
+    # Returns: The HTML of EA Forum page post, and its ETag.
+    def ea_page(self, post):
+        with self.lock:
+            if post not in self.ea_pages:
+                shape = comment_tree(self.rng('ea shape', post), self.comments, self.depth)
+                page = ea_forum_page(self.rng('ea', post), shape)
+                self.ea_pages[post] = (page, '"%s"' % hashlib.sha1(page).hexdigest())
+            return self.ea_pages[post]
+
+    # Returns: The comments on Facebook post post, in the order they were
+    # made, as the Graph API describes them, plus the id of each one's parent
+    # (None for top level comments).
+    def facebook_post(self, post):
+        with self.lock:
+            if post not in self.facebook_comments:
+                rng = self.rng('facebook', post)
+                shape = comment_tree(self.rng('facebook shape', post), self.comments,
+                                     FACEBOOK_DEPTH, prefix='%s_' % post)
+                shape.sort(key=lambda (comment_id, _): int(comment_id.split('_')[1]))
+                comments = []
+                for comment_id, parent in shape:
+                    created = FACEBOOK_EPOCH + 60 * int(comment_id.split('_')[1])
+                    author = FACEBOOK_OWNER_ID if rng.random() < 0.2 else 'u%d' % rng.randint(1, 50)
+                    comments.append(({
+                        'id': comment_id,
+                        'from': { 'id': author, 'name': 'User %s' % author },
+                        'message': sentence(rng, 30),
+                        'created_time': time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime(created))
+                    }, parent))
+                self.facebook_comments[post] = comments
+            return self.facebook_comments[post]
+
+    def create_disqus_comment(self, thread, message, parent):
+        with self.lock:
+            self.disqus_ids += 1
+            comment = {
+                'id': str(self.disqus_ids),
+                'thread': thread,
+                'parent': int(parent) if parent else None,
+                'message': message,
+                'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+                'isApproved': False
+            }
+            self.disqus_comments.append(comment)
+            return comment
+
+# page_size: How many items go in a page.
+# after: The cursor given by the client, if any.
+# Returns: One page of items, and the cursor for the next page or None.
+def paginate(items, page_size, after):
+    start = int(after) if after else 0
+    end = start + page_size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive, as the real websites do
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one piece, so that Nagle's algorithm does not
+    # hold parts of it back and add latency the real websites do not have
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.handle_request(parse_qs(body))
+
+    def handle_request(self, arguments):
+        time.sleep(self.server.latency)
+        path = urlparse(self.path).path
+        arguments = { k:(v if len(v) > 1 or k in ['post', 'include'] else v[0])
+                      for k, v in arguments.items() }
+        handlers = [('/disqus/', self.disqus), ('/graph/v2.8/', self.graph),
+                    ('/ea/', self.ea), ('/control/', self.control)]
+        for prefix, handler in handlers:
+            if path.startswith(prefix):
+                return handler(path[len(prefix):], arguments)
+        self.reply(404, 'text/plain', 'Not found')
+
+    def reply(self, status, content_type, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, result):
+        self.reply(200, 'application/json', json.dumps(result))
+
+    def disqus(self, endpoint, arguments):
+        world = self.server.world
+        limit = int(arguments.get('limit', 25))
+        if endpoint == 'threads/listPosts.json':
+            with world.lock:
+                comments = [c for c in world.disqus_comments
+                            if c['thread'] == arguments['thread']
+                            and c['createdAt'] >= arguments.get('since', '')]
+            if arguments.get('order') != 'asc':
+                comments.reverse()
+            page, cursor = paginate(comments, limit, arguments.get('cursor'))
+            self.reply_json({ 'code': 0, 'response': page,
+                              'cursor': { 'hasNext': cursor is not None, 'next': cursor } })
+        elif endpoint == 'forums/listThreads.json':
+            threads = [{ 'id': 'd%d' % i, 'clean_title': 'Post %d' % i }
+                       for i in range(1, world.posts + 1)]
+            page, cursor = paginate(threads, limit, arguments.get('cursor'))
+            self.reply_json({ 'code': 0, 'response': page,
+                              'cursor': { 'hasNext': cursor is not None, 'next': cursor } })
+        elif endpoint == 'posts/create.json':
+            comment = world.create_disqus_comment(arguments['thread'], arguments['message'],
+                                                  arguments.get('parent'))
+            self.reply_json({ 'code': 0, 'response': comment })
+        elif endpoint == 'posts/approve.json':
+            approved = set(arguments.get('post', []))
+            with world.lock:
+                for comment in world.disqus_comments:
+                    if comment['id'] in approved:
+                        comment['isApproved'] = True
+            self.reply_json({ 'code': 0, 'response': [{ 'id': i } for i in sorted(approved)] })
+        else:
+            self.reply(404, 'application/json', json.dumps({ 'code': 1, 'response': 'No such endpoint' }))
+
+    # Returns: A Graph API page of comments, as a dictionary.
+    # comments: The (comment, parent) pairs to page through.
+    def graph_page(self, comments, limit, after, fields, replies):
+        page, cursor = paginate(comments, limit, after)
+        data = []
+        for comment, parent in page:
+            comment = dict(comment)
+            if 'parent{id}' in fields and parent is not None:
+                comment['parent'] = { 'id': parent }
+            nested = re.search(r'comments\.limit\((\d+)\)', fields)
+            if nested and replies.get(comment['id']):
+                comment['comments'] = self.graph_page(replies[comment['id']], int(nested.group(1)),
+                                                      None, '', {})
+            data.append(comment)
+        result = { 'data': data }
+        if cursor is not None:
+            result['paging'] = { 'cursors': { 'after': cursor }, 'next': self.path }
+        return result
+
+    # Returns: The status and body of a Graph API request for the comments
+    # edge of object_id.
+    def graph_comments(self, object_id, arguments):
+        post = object_id.split('_')[0]
+        comments = self.server.world.facebook_post(post)
+        replies = {}
+        for comment, parent in comments:
+            replies.setdefault(parent, []).append((comment, parent))
+        fields = arguments.get('fields', '')
+        limit = int(arguments.get('limit', 25))
+        after = arguments.get('after')
+        if '_' in object_id:
+            return self.graph_page(replies.get(object_id, []), limit, after, fields, {})
+        if arguments.get('filter') == 'stream':
+            since = int(arguments.get('since', 0))
+            recent = [(c, p) for c, p in comments
+                      if FACEBOOK_EPOCH + 60 * int(c['id'].split('_')[1]) >= since]
+            return self.graph_page(recent, limit, after, fields, {})
+        return self.graph_page(replies.get(None, []), limit, after, fields, replies)
+
+    def graph(self, endpoint, arguments):
+        if endpoint == '':
+            results = []
+            for request in json.loads(arguments['batch']):
+                url = urlparse(request['relative_url'])
+                query = { k:v[0] for k, v in parse_qs(url.query).items() }
+                body = self.graph_comments(url.path.split('/')[0], query)
+                results.append({ 'code': 200, 'body': json.dumps(body) })
+            return self.reply_json(results)
+        match = re.match(r'([0-9_]+)/comments$', endpoint)
+        if match is None:
+            return self.reply(404, 'application/json', json.dumps({ 'error': 'No such edge' }))
+        self.reply_json(self.graph_comments(match.group(1), arguments))
+
+    def ea(self, path, arguments):
+        match = re.match(r'(\d+)/$', path)
+        if match is None:
+            return self.reply(404, 'text/html', 'Not found')
+        page, etag = self.server.world.ea_page(match.group(1))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.reply(200, 'text/html; charset=utf-8', page, { 'ETag': etag })
+
+    def control(self, command, arguments):
+        if command != 'grow':
+            return self.reply(404, 'text/plain', 'Not found')
+        self.server.world.grow(int(arguments['comments']))
+        self.reply_json({ 'comments': self.server.world.comments })
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # world: The World to serve.
+    # latency: How many seconds to wait before answering each request.
+    def __init__(self, world, latency=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.world = world
+        self.latency = latency
+
+    def base_url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve stand-ins for Disqus, Facebook and the EA Forum.')
+    parser.add_argument('--posts', type=int, default=10)
+    parser.add_argument('--comments', type=int, default=100,
+                        help='How many comments each post has on each website')
+    parser.add_argument('--depth', type=int, default=6,
+                        help='Maximum reply depth of EA Forum comments')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=0)
+    params = parser.parse_args()
+
+    server = Server(World(params.posts, params.comments, params.depth, params.seed),
+                    params.latency, params.port)
+    print server.server_address[1]
+    sys.stdout.flush()
+    server.serve_forever()
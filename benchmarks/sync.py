@@ -0,0 +1,139 @@
+import argparse, imp, os, resource, shutil, subprocess, sys, tempfile, time, urllib2
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+sys.path.insert(0, ROOT)
+from standins import FACEBOOK_OWNER_ID
+
+# Runs whole sync iterations against the stand-ins in standins.py, which run
+# in their own process, so that changes to the sync can be measured without
+# touching the real websites. The first iteration copies every comment; each
+# later one first adds --grow comments to every post on both websites.
+#
+#   python benchmarks/sync.py --posts 20 --comments 200 --iterations 3 --grow 10
+#
+# For each iteration this reports the wall time and the time spent in each
+# stage, the requests made per comment copied and the peak RSS of the syncing
+# process. What the sync itself prints is hidden unless --verbose is given.
+
+# Credentials for the stand-ins, so that no keys.py is needed and the real
+# ones are never used
+FAKE_KEYS = {
+    'DISQUS_GLOBAL_KEY': 'global-key',
+    'DISQUS_PUBLIC_KEY': 'public-key',
+    'DISQUS_SECRET': 'secret',
+    'DISQUS_FORUM_NAME': 'forum',
+    'DISQUS_OWNER_ACCESS_TOKEN': 'owner-token',
+    'DISQUS_ADMIN_ACCESS_TOKEN': 'admin-token',
+    'FB_APP_ID': 'app-id',
+    'FB_APP_SECRET': 'app-secret',
+    'FB_OWNER_ID': FACEBOOK_OWNER_ID,
+    'FB_LONG_CODE': 'access-token'
+}
+
+# The parts of a sync iteration that are timed separately
+STAGES = ['fetch', 'enqueue', 'copy', 'approve']
+
+# The stand-ins do not rate limit, so neither do we
+UNLIMITED = { k:(10 ** 9, 10 ** 6) for k in ['global', 'app', 'admin'] }
+
+def install_fake_keys():
+    keys = imp.new_module('keys')
+    keys.__dict__.update(FAKE_KEYS)
+    sys.modules['keys'] = keys
+
+# Starts the stand-ins in a separate process.
+# Returns: The process, and the base url of the stand-ins.
+def start_standins(params):
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS, 'standins.py'),
+                                '--posts', str(params.posts),
+                                '--comments', str(params.comments),
+                                '--depth', str(params.depth),
+                                '--latency', str(params.latency)],
+                               stdout=subprocess.PIPE)
+    port = int(process.stdout.readline())
+    return process, 'http://127.0.0.1:%d/' % port
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run(params, base_url, directory):
+    install_fake_keys()
+    from adts import Post, PostIndex
+    from api import DisqusAPI, EAForumAPI, FacebookAPI, RateLimiter
+    from cache import PageCache
+    from config import EA_FORUM_STRING, FACEBOOK_STRING
+    from metrics import metrics
+    from outbox import Outbox
+    from store import SqliteStore
+    copy_comments = imp.load_source('copy_comments', os.path.join(ROOT, 'copy-comments.py'))
+
+    store = SqliteStore(False, os.path.join(directory, 'sync_state.db'))
+    posts = [Post('d%d' % i, { EA_FORUM_STRING: base_url + 'ea/%d/' % i, FACEBOOK_STRING: str(i) })
+             for i in range(1, params.posts + 1)]
+    store.save_posts(posts)
+    source_apis = {
+        EA_FORUM_STRING: EAForumAPI(False, cache=PageCache(os.path.join(directory, 'page_cache'))),
+        FACEBOOK_STRING: FacebookAPI(False, graph_url=base_url + 'graph/v2.8/')
+    }
+    disqusApi = DisqusAPI(False, api_url=base_url + 'disqus/',
+                          rate_limiter=RateLimiter(UNLIMITED, 0, 0))
+    disqusApi.defer_approvals(store)
+    outbox = Outbox(store, disqusApi, PostIndex(posts))
+    sync_params = argparse.Namespace(debug=False, prefer_user_post_data=False)
+    print 'Baseline RSS after imports: %d KB' % peak_rss()
+
+    results = []
+    for iteration in range(1, params.iterations + 1):
+        if iteration > 1 and params.grow:
+            urllib2.urlopen(base_url + 'control/grow', 'comments=%d' % params.grow).read()
+        requests = metrics.total('requests')
+        copied = metrics.total('comments_copied')
+        stages = [metrics.seconds('stage_seconds', stage=stage) for stage in STAGES]
+        start = time.time()
+        stdout = sys.stdout
+        if not params.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            copy_comments.sync(posts, source_apis, outbox, store, sync_params)
+        finally:
+            sys.stdout = stdout
+        elapsed = time.time() - start
+        requests = metrics.total('requests') - requests
+        copied = metrics.total('comments_copied') - copied
+        stages = [metrics.seconds('stage_seconds', stage=stage) - before
+                  for stage, before in zip(STAGES, stages)]
+        per_comment = '%.2f' % (float(requests) / copied) if copied else 'n/a'
+        print ('Iteration %d: %.2fs (%s), %d comments copied, %d requests (%s per comment), '
+               'peak RSS %d KB') % (iteration, elapsed,
+                                    ', '.join('%s %.2fs' % s for s in zip(STAGES, stages)),
+                                    copied, requests, per_comment, peak_rss())
+        results.append((elapsed, copied, requests))
+    print 'Requests by endpoint:'
+    for line in metrics.prometheus().splitlines():
+        if line.startswith(metrics.prefix + 'requests{'):
+            print '  ' + line[len(metrics.prefix):]
+    store.close()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark sync iterations against local stand-ins.')
+    parser.add_argument('--posts', type=int, default=10)
+    parser.add_argument('--comments', type=int, default=100,
+                        help='How many comments each post starts with on each website')
+    parser.add_argument('--depth', type=int, default=6,
+                        help='Maximum reply depth of EA Forum comments')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds the stand-ins wait before answering each request')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--grow', type=int, default=5,
+                        help='How many comments to add to each post on each website between iterations')
+    parser.add_argument('--verbose', action='store_true', help='Show what the sync prints')
+    params = parser.parse_args()
+
+    process, base_url = start_standins(params)
+    directory = tempfile.mkdtemp()
+    try:
+        run(params, base_url, directory)
+    finally:
+        process.kill()
+        shutil.rmtree(directory)
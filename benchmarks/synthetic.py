@@ -0,0 +1,75 @@
+import random
+
+# Generates fake data that looks like what the real websites return, for
+# benchmarking without touching the real websites.
+
+WORDS = ['effective', 'altruism', 'comment', 'post', 'thanks', 'interesting',
+         'argument', 'evidence', 'charity', 'impact', 'however', 'agree']
+
+def sentence(rng, words=20):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+# Generates a random comment tree shape.
+# num_comments: How many comments there are in total.
+# max_depth: How deeply comments may be nested, where 1 means no replies.
+# Returns: A list of (comment id, parent id) pairs in pre-order, where the
+#          parent id is None for top level comments.
+def comment_tree(rng, num_comments, max_depth, prefix='c'):
+    comments = []
+    depths = {}
+    # The comments that can still be replied to
+    open_comments = []
+    for i in range(num_comments):
+        comment_id = '%s%d' % (prefix, i)
+        parent = None
+        if open_comments and rng.random() < 0.6:
+            parent = rng.choice(open_comments)
+        depths[comment_id] = 1 if parent is None else depths[parent] + 1
+        if depths[comment_id] < max_depth:
+            open_comments.append(comment_id)
+        comments.append((comment_id, parent))
+    # Put the comments in pre-order, which is the order pages display them in
+    children = {}
+    for comment_id, parent in comments:
+        children.setdefault(parent, []).append(comment_id)
+    result = []
+    stack = list(reversed(children.get(None, [])))
+    parents = dict(comments)
+    while stack:
+        comment_id = stack.pop()
+        result.append((comment_id, parents[comment_id]))
+        stack.extend(reversed(children.get(comment_id, [])))
+    return result
+
+# Returns: The HTML of an EA Forum post page with the given comments, in the
+# markup that EAForumAPI scrapes.
+# comments: A list of (comment id, parent id) pairs, as from comment_tree.
+def ea_forum_page(rng, comments, owner='rohinmshah'):
+    children = {}
+    for comment_id, parent in comments:
+        children.setdefault(parent, []).append(comment_id)
+
+    def render(comment_id, parent):
+        author = owner if rng.random() < 0.2 else 'user%d' % rng.randint(1, 50)
+        parts = ['<div class="comment thing">',
+                 '<p class="parent"><a name="%s"></a></p>' % comment_id,
+                 '<div class="entry">',
+                 '<span class="comment-author"><a href="/user/%s/">%s</a></span>' % (author, author),
+                 '<div class="comment-content"><div class="md"><p>%s</p><ul><li>%s</li></ul></div></div>'
+                 % (sentence(rng, 60), sentence(rng)),
+                 '<ul class="buttons"><li><a href="#%s">Permalink</a></li>' % comment_id]
+        if parent is not None:
+            parts.append('<li class="parent"><a href="#%s">Parent</a></li>' % parent)
+        parts.append('</ul></div><div class="child">')
+        parts.extend(render(c, comment_id) for c in children.get(comment_id, []))
+        parts.append('</div></div>')
+        return ''.join(parts)
+
+    # The rest of the page is what makes real pages large
+    header = ''.join('<div class="sidebar-item"><p>%s</p></div>' % sentence(rng, 40)
+                     for _ in range(200))
+    body = ''.join('<p>%s</p>' % sentence(rng, 80) for _ in range(100))
+    thread = ''.join(render(c, None) for c in children.get(None, []))
+    return ('<html><head><title>Post</title></head><body>%s'
+            '<div class="post"><div class="md">%s</div></div>'
+            '<div id="comments">%s</div></body></html>') % (header, body, thread)
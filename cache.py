@@ -0,0 +1,133 @@
+import hashlib, os, pickle, threading, time
+from config import *
+
+# An on-disk cache for pages that are scraped over and over again.
+# Entries are kept under a key made of the url and whatever else the result
+# depends on, such as the user whose comments are owner comments, so that
+# different results from the same page are kept apart.
+# For each key it remembers the ETag and Last-Modified headers, so that the
+# server can reply with a 304 if the page has not changed, as well as a hash of
+# the part of the page that we care about and the result that was computed
+# from it, so that a page whose relevant part did not change is not parsed
+# again.
+# Counts of what happened are kept in stats. Safe to share between threads.
+class PageCache:
+    # Bump this whenever the format of the cached results changes, so that old
+    # entries are ignored instead of being unpickled into the wrong shape.
+    VERSION = 3
+
+    # read_only: If set, entries are used but never saved, and directory is
+    #            not created.
+    def __init__(self, directory=PAGE_CACHE_DIR, read_only=False):
+        self.directory = directory
+        self.read_only = read_only
+        if not read_only and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.stats = {
+            'not_modified': 0,
+            'unchanged': 0,
+            'changed': 0,
+            'bytes_downloaded': 0,
+            'bytes_saved': 0
+        }
+
+    # key: A tuple of strings, starting with the url of the page.
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key)).hexdigest() + '.pickle')
+
+    # Returns: The cache entry for key (a dictionary), or None if there is no
+    # usable entry.
+    def load(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            # A missing, truncated or outdated entry is just a cache miss
+            return None
+        if entry.get('version') != self.VERSION or entry.get('key') != key:
+            return None
+        return entry
+
+    # Saves the cache entry for key. The entry is written to a temporary file
+    # first, so a crash never leaves a half written entry behind.
+    # response: The HTTP response that the result was computed from.
+    # digest: The hash of the relevant part of the page.
+    # result: What was computed from the page.
+    def save(self, key, response, digest, result):
+        if self.read_only:
+            return
+        entry = {
+            'version': self.VERSION,
+            'key': key,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'size': len(response.content),
+            'digest': digest,
+            'result': result
+        }
+        path = self.path(key)
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+
+    # entry: The cache entry for a page, or None.
+    # Returns: The headers to send to make a conditional request for the page.
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    # Returns: A one line summary of stats.
+    def report(self):
+        with self.lock:
+            return ('%(not_modified)d not modified, %(unchanged)d unchanged, '
+                    '%(changed)d parsed, %(bytes_downloaded)d bytes downloaded, '
+                    '%(bytes_saved)d bytes saved') % self.stats
+
+# An on-disk cache of API answers that rarely change, such as the list of
+# posts on a forum, for commands that are run over and over again. Answers are
+# used for up to ttl seconds after they were fetched.
+class ResponseCache:
+    VERSION = 1
+
+    def __init__(self, directory=RESPONSE_CACHE_DIR, ttl=RESPONSE_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    # key: A tuple of strings that identifies the answer, including whatever
+    #      account it was asked for.
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key)).hexdigest() + '.pickle')
+
+    # Returns: The answer saved under key, or compute() if there is no answer
+    #          younger than ttl, in which case that is saved.
+    def get(self, key, compute):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            if (entry.get('version') == self.VERSION and entry.get('key') == key
+                    and time.time() - entry['time'] < self.ttl):
+                return entry['value']
+        except Exception:
+            # A missing, truncated or outdated entry is just a cache miss
+            pass
+        value = compute()
+        entry = { 'version': self.VERSION, 'key': key, 'time': time.time(), 'value': value }
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+        return value
@@ -1,11 +1,127 @@
 # If you change this, make sure to also change post_data.json
 EA_FORUM_STRING = 'the EA Forum'
 FACEBOOK_STRING = 'Facebook'
+# The websites to copy comments from, in the order they are synced
+WEBSITES = [EA_FORUM_STRING, FACEBOOK_STRING]
 
-# Run once every 5 minutes
+# Sites (blogs) to sync, each with its own Disqus forum, source accounts and
+# post data; see sites.py for the format. Without this file there is a single
+# site, DEFAULT_SITE, set up from keys.py and USER_POSTS_FILE.
+SITES_FILE = 'sites.json'
+DEFAULT_SITE = 'default'
+# The EA Forum username of the default site's owner
+EA_FORUM_OWNER = 'rohinmshah'
+# How many polls each site may make per hour, and in one burst, unless
+# sites.json says otherwise. This keeps a site with many busy threads from
+# delaying the others.
+SITE_POLL_BUDGET = 3600
+SITE_POLL_BURST = 100
+
+# Each thread is polled every 5 minutes at first. After that, a thread with new
+# comments is polled again after between SCHEDULER_FLOOR and DELAY seconds,
+# sooner the faster comments are arriving, and each poll that finds nothing
+# multiplies the wait by SCHEDULER_BACKOFF, up to SCHEDULER_CEILING.
 DELAY = 300
+SCHEDULER_FLOOR = 15
+SCHEDULER_CEILING = 6 * 60 * 60
+SCHEDULER_BACKOFF = 2
+
+# How many threads fetch comments from each website at the same time
+FETCH_CONCURRENCY = {
+    EA_FORUM_STRING: 4,
+    FACEBOOK_STRING: 4
+}
+
+# Comments to copy are queued in the outbox in STATE_DB_FILE and created on
+# Disqus by a separate writer, OUTBOX_CONCURRENCY at once, still within the
+# rate limits. The comments of a thread are created in order, unless it has
+# at least BACKFILL_THRESHOLD queued (say, a post that was just added to
+# post_data.json), in which case they are created in parallel. A comment
+# that fails is retried after OUTBOX_INITIAL_BACKOFF * 2^n seconds, up to
+# OUTBOX_MAX_BACKOFF. The writer also checks the outbox every
+# OUTBOX_POLL_INTERVAL seconds, for comments queued by other workers.
+OUTBOX_CONCURRENCY = 4
+BACKFILL_THRESHOLD = 20
+OUTBOX_INITIAL_BACKOFF = 30
+OUTBOX_MAX_BACKOFF = 60 * 60
+OUTBOX_POLL_INTERVAL = 60
+
+# Whether the main loop checks the record of copied comments against Disqus
+# when it starts, and how many posts are checked at the same time
+RECONCILE_ON_START = True
+RECONCILE_CONCURRENCY = 4
+
+# Workers started with the worker command share the posts between them by
+# taking leases on them in STATE_DB_FILE. A lease lasts LEASE_DURATION seconds
+# and is renewed every LEASE_RENEW_INTERVAL seconds; the posts of a worker
+# that stops renewing are taken over once its leases expire. A post is only
+# synced while its lease has more than LEASE_MARGIN seconds left.
+LEASE_DURATION = 180
+LEASE_RENEW_INTERVAL = 60
+LEASE_MARGIN = 60
+
+# With --webhook PORT, loop and worker listen on WEBHOOK_HOST:PORT for
+# notifications that a thread has new comments (see webhook.py). Facebook
+# checks the subscription with this verify token; leave it as None to refuse
+# subscriptions.
+WEBHOOK_HOST = '127.0.0.1'
+WEBHOOK_VERIFY_TOKEN = None
 
 # Files to save information in
 USER_POSTS_FILE = 'post_data.json'
+STATE_DB_FILE = 'sync_state.db'
+# Older versions pickled all of their state here; it is imported into
+# STATE_DB_FILE the first time we start up.
 PICKLED_POSTS_FILE = 'posts_data_structure.pickle'
+# Scraped EA Forum pages are cached here
+PAGE_CACHE_DIR = 'page_cache'
+# The answers to the listing commands (disqus-ids and fb-posts) are cached
+# here for RESPONSE_CACHE_TTL seconds, unless --no-cache is given
+RESPONSE_CACHE_DIR = 'response_cache'
+RESPONSE_CACHE_TTL = 10 * 60
+# Metrics are written here after every sync iteration: in the Prometheus text
+# format, or as JSON lines if the name ends in .jsonl
+METRICS_FILE = 'metrics.prom'
+METRICS_PREFIX = 'comment_sync_'
+# How many of the slowest functions --profile prints
+PROFILE_TOP_FUNCTIONS = 25
+
+# Where the APIs live. These only change to point at stand-ins, as the
+# benchmarks do.
+DISQUS_API_URL = 'https://disqus.com/api/3.0/'
+FACEBOOK_GRAPH_URL = 'https://graph.facebook.com/v2.8/'
+
+# Disqus counts requests separately for the global key, the app key and the
+# admin access token, and allows 1000 requests per hour for each of them.
+# Each entry is (requests per hour, maximum burst).
+DISQUS_RATE_LIMITS = {
+    'global': (1000, 50),
+    'app': (1000, 50),
+    'admin': (1000, 50)
+}
+# How many times to retry a request that Disqus rejects as rate limited, and
+# how long to wait (in seconds) before the first retry.
+DISQUS_MAX_RETRIES = 5
+DISQUS_INITIAL_BACKOFF = 30
+# Guest comments are approved this many at a time, and at the end of each
+# iteration
+APPROVE_BATCH_SIZE = 25
+# Whether to fetch the next page of a Disqus listing while the current one is
+# being processed
+DISQUS_PREFETCH = True
+
+# Connections kept open per host, timeout (in seconds) for each request, and
+# how many times to retry connection errors and gateway failures, waiting
+# HTTP_BACKOFF * 2^n seconds between attempts.
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 1
 
+# Comments requested per page from the Graph API, and the most requests sent in
+# a single Graph batch request
+FB_PAGE_LIMIT = 100
+FB_BATCH_SIZE = 50
+# When only asking Facebook for new comments, also ask for the ones made this
+# many seconds before the newest comment we have seen
+FB_SINCE_OVERLAP = 300
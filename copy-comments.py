@@ -1,59 +1,173 @@
-import argparse, json, os.path, pickle, sys, time
-from api import FacebookAPI, DisqusAPI, EAForumAPI
-from adts import Post, RealComment
+import argparse, json, os, os.path, socket, sys, time
+from multiprocessing.pool import ThreadPool
+from adts import Post, PostIndex, RealComment, CommentPointer
+from cache import PageCache, ResponseCache
 from config import *
+from leases import Leases
+from metrics import metrics
+from outbox import Outbox
+from scheduler import Scheduler
+from sites import load_sites
+from store import open_store, migrate_pickle
+
+# Returns: A list of (post, website) pairs, one for each website that each post
+# in all_posts copies comments from, in the order they should be synced.
+# source_apis: The API objects of the site, as from Site.make_source_apis.
+#              Websites without one are left out.
+def make_jobs(all_posts, source_apis):
+    return [(post, website) for post in all_posts
+            for website in WEBSITES if website in post.other_ids and website in source_apis]
+
+# Fetches the comments in one thread. Where the website supports it, only the
+# comments made since the thread's high-water mark are fetched.
+# api: The API object that reads comments from website.
+# Returns: A (thread_id, root, since) triple, where root is the Tree of
+#          comments and since is the timestamp they were fetched since, or None
+#          if root holds every comment in the thread.
+def fetch_thread(api, post, website, thread_id):
+    def get_comments(*args):
+        with metrics.timer('get_comments_seconds', source=website):
+            return api.get_comments(*args)
+
+    mark = post.high_water.get(website, {}).get(thread_id, {})
+    since = mark.get('newest') if api.SUPPORTS_SINCE else None
+    if since is None:
+        return (thread_id, get_comments(thread_id), None)
+
+    root = get_comments(thread_id, since)
+    copied_comments = post.copied_comments.get(website, {})
+    pointers = [node.item.id for node in root.children if isinstance(node.item, CommentPointer)]
+    if all(pointer in copied_comments for pointer in pointers):
+        return (thread_id, root, since)
+    # There are new replies to comments that we never copied, so we need the
+    # whole thread to place them.
+    return (thread_id, get_comments(thread_id), None)
+
+# Fetches the comment trees for every job. Each website gets its own pool of
+# FETCH_CONCURRENCY[website] threads, and all of the websites are fetched at
+# the same time.
+# jobs: A list of (post, website) pairs to fetch comments for.
+# source_apis: A dictionary mapping each website to the API object that reads
+#              comments from it.
+# Returns: A dictionary mapping (post.disqus_id, website) to a list with the
+#          result of fetch_thread for each thread id, in the same order as the
+#          thread ids. A job with a thread that could not be fetched is left
+#          out, and the error is printed and counted as a fetch_failure.
+def fetch_all_comments(jobs, source_apis, params):
+    pending = []
+    for website in WEBSITES:
+        tasks = [(post, thread_id) for post, job_website in jobs
+                 if job_website == website
+                 for thread_id in post.thread_ids(website)]
+        if not tasks:
+            continue
+        api = source_apis[website]
+        pool = ThreadPool(FETCH_CONCURRENCY[website])
+        def fetch(task, api=api, website=website):
+            post, thread_id = task
+            try:
+                return fetch_thread(api, post, website, thread_id)
+            except Exception as e:
+                print 'Failed to fetch thread', thread_id, 'of post', post.disqus_id, 'on', website, '-', e
+                metrics.count('fetch_failures', source=website)
+                return None
+        async_result = pool.map_async(fetch, tasks)
+        pool.close()
+        pending.append((website, tasks, async_result))
+
+    trees = {}
+    failed = set()
+    for website, tasks, async_result in pending:
+        # A timeout is needed for the wait to be interruptible by Ctrl-C
+        for (post, _), result in zip(tasks, async_result.get(sys.maxint)):
+            if result is None:
+                failed.add((post.disqus_id, website))
+            else:
+                trees.setdefault((post.disqus_id, website), []).append(result)
+    for key in failed:
+        trees.pop(key, None)
+    return trees
 
 # post: A Post object that has an id for the given website
 # website: Which website to copy comments from.
-# Copies any new comments from website to Disqus.
+# threads: The comments on website, as a list of results of fetch_thread.
+# outbox: The Outbox that creates the comments on Disqus.
+# store: The Store in which to record the high-water marks.
+# Queues any new comments from website to be copied to Disqus.
 # Note website is not a URL, it is simply an identifier like "Facebook" that is
 # used to extract information out of the Post object.
-def sync_website_comments(post, website, api, save_fn, params):
-    if website not in post.other_ids:
-        return
+# Threads whose fingerprint matches their high-water mark are skipped, and
+# within the rest only the top level comments whose fingerprint changed are
+# walked. The comments are queued before the high-water mark moves past them,
+# so none are lost if we stop before they are copied.
+# Returns: The number of comments that were newly queued.
+def sync_website_comments(post, website, threads, outbox, store, params):
+    copied_comments = post.copied_comments.setdefault(website, {})
+    high_water = post.high_water.setdefault(website, {})
 
-    copied_comments = post.copied_comments[website]
-    disqusApi = DisqusAPI(params.debug)
-    
-    def loop(comment_node, disqus_parent):
-        # Handle the current comment
-        comment = comment_node.item
-        if comment.id not in copied_comments:
-            disqus_id = disqusApi.guarded_make_comment(comment, post.disqus_id, disqus_parent, params.debug)
-            copied_comments[comment.id] = disqus_id
-            save_fn()
-            time.sleep(10)
-
-        # Recurse over the children
-        for child in comment_node.children:
-            loop(child, copied_comments[comment.id])
-    
-    thread_ids = post.other_ids[website]
-    if type(thread_ids) != type([]):
-        thread_ids = [ thread_ids ]
-    for thread_id in thread_ids:
-        root = api.get_comments(thread_id)
-        for node in root.children:
-            loop(node, None)
-
-# TODO: Currently we depend on the pickled file remaining -- if the pickled file
-# is deleted, then all the comments will be re-copied, causing duplicates.
-def create_all_posts_data_structure(params):
-    previous_all_posts = []
-    if os.path.isfile(PICKLED_POSTS_FILE):
-        with open(PICKLED_POSTS_FILE) as f:
-            previous_all_posts = pickle.load(f)
+    # Returns: A (comment, parent_id) pair for every comment under each of
+    # branches (top level comments) that has not been copied, in pre-order so
+    # that each comment comes before its replies.
+    def uncopied(branches):
+        comments = []
+        stack = [(branch, None) for branch in reversed(branches)]
+        while stack:
+            comment_node, parent_id = stack.pop()
+            comment = comment_node.item
+            # Pointers stand for comments fetched before, which are copied
+            # or already queued
+            if comment.id not in copied_comments and isinstance(comment, RealComment):
+                comments.append((comment, parent_id))
+            stack.extend((child, comment.id) for child in reversed(comment_node.children))
+        return comments
+
+    num_queued = 0
+    for thread_id, root, since in threads:
+        mark = dict(high_water.get(thread_id, {}))
+        if since is None:
+            fingerprints = root.fingerprints()
+            if mark.get('fingerprint') == fingerprints[root]:
+                continue
+            branches = mark.get('branches', {})
+            comments = uncopied([node for node in root.children
+                                 if branches.get(node.item.id) != fingerprints[node]])
+            mark['fingerprint'] = fingerprints[root]
+            mark['branches'] = { node.item.id:fingerprints[node] for node in root.children }
+        else:
+            comments = uncopied(root.children)
+        num_queued += outbox.enqueue(post, website, comments)
+
+        mark['newest'] = newest_timestamp(root, mark.get('newest'))
+        if mark != high_water.get(thread_id):
+            high_water[thread_id] = mark
+            store.record_high_water(post, website, thread_id)
+    return num_queued
+
+# Returns: The latest timestamp of a comment in the tree, or newest if that is
+# later.
+def newest_timestamp(root, newest):
+    for node in root.preorder():
+        timestamp = getattr(node.item, 'timestamp', None)
+        if timestamp is not None and (newest is None or timestamp > newest):
+            newest = timestamp
+    return newest
+
+# If the state file is lost, run reconcile before syncing so that comments
+# that are already on Disqus are not copied again.
+# posts_file: The user post data of the site to sync.
+# Returns: A PostIndex of the posts in the user post data, in order.
+def create_all_posts_data_structure(store, params, posts_file=USER_POSTS_FILE):
+    previous_all_posts = store.load_posts()
+    if not previous_all_posts and os.path.isfile(PICKLED_POSTS_FILE):
+        previous_all_posts = migrate_pickle(store, PICKLED_POSTS_FILE)
+    old_posts_by_id = { p.disqus_id:p for p in previous_all_posts }
 
     post_data = None
-    with open(USER_POSTS_FILE) as f:
+    with open(posts_file) as f:
         post_data = json.load(f)
 
-    def find_old_post(id):
-        matching_posts = [p for p in previous_all_posts if p.disqus_id == id]
-        return matching_posts[0] if matching_posts else None
-
     def get_post_object(post_dict):
-        old_post_object = find_old_post(post_dict['disqus'])
+        old_post_object = old_posts_by_id.get(post_dict['disqus'])
         new_post_object = Post(post_dict['disqus'], post_dict['others'])
         if old_post_object is not None and not old_post_object.has_same_links(new_post_object):
             if params.prefer_user_post_data:
@@ -65,41 +179,337 @@ def create_all_posts_data_structure(params):
                 raise ValueError('Old post and new post have different links!\nOld post: %s\nNew post: %s' % (old_post_object.other_ids, new_post_object.other_ids))
         return old_post_object if old_post_object else new_post_object
 
-    all_posts = [get_post_object(post_dict) for post_dict in post_data]
+    all_posts = PostIndex(get_post_object(post_dict) for post_dict in post_data)
     # get_post_object may have changed data, so save that data
-    save(all_posts, params)
+    store.save_posts(all_posts)
     return all_posts
 
+# Rebuilds the record of copied comments from the comments on Disqus, using
+# the link to the original comment that DisqusAPI.create_message adds to each
+# one. Only comments made since the previous reconcile of a post are listed,
+# so after the first run this costs about one request per post.
+# Returns: The number of copied comments that were missing from the record.
+def reconcile(all_posts, source_apis, disqusApi, store):
+    marks = store.load_reconcile_marks()
 
-def save(all_posts, params):
-    if params.debug:
-        print 'Not pickling all_posts since we are in debug mode'
-    else:
-        with open(PICKLED_POSTS_FILE, 'w') as f:
-            pickle.dump(all_posts, f)
+    def reconcile_post(post):
+        newest = since = marks.get(post.disqus_id)
+        missing = []
+        for message in disqusApi.get_comments_on_thread(post.disqus_id, since):
+            if newest is None or message['createdAt'] > newest:
+                newest = message['createdAt']
+            source = disqusApi.parse_synced_from(message['message'])
+            if source is None or source[0] not in source_apis:
+                continue
+            website, url = source
+            comment_id = source_apis[website].comment_id_from_url(url)
+            copied_comments = post.copied_comments.setdefault(website, {})
+            disqus_id = copied_comments.get(comment_id)
+            if disqus_id is None:
+                copied_comments[comment_id] = message['id']
+                missing.append((post, website, comment_id, message['id']))
+            elif str(disqus_id) != message['id']:
+                print 'Duplicate of', disqus_id, 'on post', post.disqus_id, 'is', message['id']
+        store.record_comments(missing)
+        if newest != since:
+            store.record_reconcile_mark(post, newest)
+        return len(missing)
+
+    pool = ThreadPool(RECONCILE_CONCURRENCY)
+    try:
+        missing = pool.map_async(reconcile_post, list(all_posts)).get(sys.maxint)
+    finally:
+        pool.close()
+    print 'Reconciled', len(missing), 'posts, found', sum(missing), 'unrecorded comments'
+    return sum(missing)
+
+# The posts of one site and the API objects to sync them with.
+class Tenant:
+    # cache: The PageCache shared by every site.
+    # rate_limiters: The RateLimiters shared by every site, as for
+    #                Site.make_disqus_api.
+    def __init__(self, site, store, params, cache, rate_limiters):
+        self.site = site
+        self.name = site.name
+        self.all_posts = create_all_posts_data_structure(store, params, site.posts_file)
+        self.source_apis = site.make_source_apis(params.debug, cache)
+        self.disqusApi = site.make_disqus_api(params.debug, rate_limiters)
+        self.disqusApi.defer_approvals(store, site=site.name)
+        self.outbox = Outbox(store, self.disqusApi, self.all_posts, site.name)
 
-def sync(all_posts, params):
-    save_fn = lambda: save(all_posts, params)
-    eaForumApi = EAForumAPI(params.debug)
-    facebookApi = FacebookAPI(params.debug)
-    for post in all_posts:
-        sync_website_comments(post, EA_FORUM_STRING, eaForumApi, save_fn, params)
-        sync_website_comments(post, FACEBOOK_STRING, facebookApi, save_fn, params)
+# Returns: Every site in SITES_FILE, or just the one named params.site if it
+# is set.
+def select_sites(params):
+    sites = [site for site in load_sites() if params.site in [None, site.name]]
+    if not sites:
+        raise ValueError('There is no site named %s' % params.site)
+    return sites
 
+# Returns: A list with a Tenant for each site, as chosen by select_sites.
+# cache: The PageCache for every site to share, by default a new one.
+def open_tenants(store, params, cache=None):
+    sites = select_sites(params)
+    if cache is None:
+        cache = PageCache()
+    rate_limiters = {}
+    return [Tenant(site, store, params, cache, rate_limiters) for site in sites]
+
+# Returns: A Scheduler that keeps each tenant within the budget of its site.
+def make_scheduler(tenants):
+    scheduler = Scheduler()
+    for tenant in tenants:
+        scheduler.set_budget(tenant.name, tenant.site.budget)
+    return scheduler
+
+# Starts listening for webhooks on params.webhook, if it is set.
+def start_webhook(params, scheduler, tenants):
+    if params.webhook is not None:
+        from webhook import Webhook
+        Webhook(scheduler, tenants, params.webhook).start()
+
+# Syncs the jobs that are due, for all tenants.
+# due: A list of Jobs.
+# Returns: A list with the number of comments queued for each job, or None
+#          for the jobs that could not be fetched.
+def sync_due_jobs(due, tenants, store, params):
+    queued = {}
+    for tenant in tenants:
+        jobs = [job for job in due if job.site == tenant.name]
+        if jobs:
+            results = sync_jobs([(job.post, job.website) for job in jobs], tenant.source_apis,
+                                tenant.outbox, store, params)
+            queued.update(zip(jobs, results))
+    return [queued[job] for job in due]
+
+# Fetches the comments for all jobs, and then queues the new ones in outbox
+# to be copied to Disqus.
+# jobs: A list of (post, website) pairs, as from make_jobs.
+# Returns: A list with the number of comments queued for each job, or None
+#          for the jobs that could not be fetched, which are left for the
+#          next sync.
+@metrics.timed('sync_seconds')
+def sync_jobs(jobs, source_apis, outbox, store, params):
+    with metrics.timer('stage_seconds', stage='fetch'):
+        trees = fetch_all_comments(jobs, source_apis, params)
+    with metrics.timer('stage_seconds', stage='enqueue'):
+        return [sync_website_comments(post, website, trees[(post.disqus_id, website)], outbox, store, params)
+                if (post.disqus_id, website) in trees else None
+                for post, website in jobs]
+
+# Calls function(*args). If params.profile is set, the call is profiled, the
+# profile is saved to params.profile and the slowest functions are printed.
+# Only the first call is profiled.
+def profile_once(params, function, *args):
+    if not params.profile:
+        return function(*args)
+    import cProfile, pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(params.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        params.profile = None
+
+# Prints a summary of the metrics and writes all of them to params.metrics.
+def export_metrics(params, iteration=None):
+    print 'Metrics:', metrics.report()
+    metrics.export(params.metrics, iteration)
+
+# Works out what syncing every post of tenants would copy, without asking
+# Disqus or recording anything. The threads are fetched as a sync would fetch
+# them and compared with the comments recorded as copied, and the comments
+# already in the outbox are added in.
+# Returns: The plan, as a dictionary that can be converted to JSON. For each
+#          site it lists the comments to create on each post and website,
+#          split into owner and guest comments, the Disqus requests that would
+#          take with each credential and how many seconds the rate limits
+#          allow them to be made in (ignoring latency).
+def plan(tenants, store, params):
+    result = { 'sites': [] }
+    # Sites that use the same keys share a RateLimiter, and so the time
+    # their requests take is worked out together: this maps each RateLimiter
+    # to the requests of all of its sites. The overall drain_seconds is the
+    # longest of these, as the limiters drain at the same time.
+    requests_by_limiter = {}
+    for tenant in tenants:
+        # Maps (post id, website) to a dictionary from the ids of the comments
+        # to create to whether they are owner comments
+        uncopied = {}
+        jobs = make_jobs(tenant.all_posts, tenant.source_apis)
+        trees = fetch_all_comments(jobs, tenant.source_apis, params)
+        for post, website in jobs:
+            copied_comments = post.copied_comments.get(website, {})
+            comments = uncopied.setdefault((post.disqus_id, website), {})
+            for thread_id, root, since in trees.get((post.disqus_id, website), []):
+                for node in root.preorder():
+                    if isinstance(node.item, RealComment) and node.item.id not in copied_comments:
+                        comments[node.item.id] = node.item.is_owner_comment
+        for post_id, website, comment, parent_id, attempts in store.load_outbox(tenant.name, float('inf')):
+            uncopied.setdefault((post_id, website), {})[comment.id] = comment.is_owner_comment
+
+        posts = []
+        for (post_id, website), comments in sorted(uncopied.items()):
+            if comments:
+                owner = sum(1 for is_owner in comments.values() if is_owner)
+                posts.append({ 'post': post_id, 'website': website, 'comments': len(comments),
+                               'owner': owner, 'guest': len(comments) - owner })
+        owner = sum(entry['owner'] for entry in posts)
+        guest = sum(entry['guest'] for entry in posts)
+        limiter = tenant.disqusApi.rate_limiter
+        requests = tenant.disqusApi.estimate_requests(owner, guest)
+        totals = requests_by_limiter.setdefault(limiter, dict.fromkeys(requests, 0))
+        for key_type, n in requests.items():
+            totals[key_type] += n
+        result['sites'].append({
+            'site': tenant.name,
+            'posts': posts,
+            'comments': owner + guest,
+            'owner': owner,
+            'guest': guest,
+            'requests': requests,
+            'drain_seconds': limiter.drain_seconds(requests)
+        })
+    result['comments'] = sum(site['comments'] for site in result['sites'])
+    result['requests'] = sum(sum(site['requests'].values()) for site in result['sites'])
+    result['drain_seconds'] = max([0] + [limiter.drain_seconds(requests)
+                                         for limiter, requests in requests_by_limiter.items()])
+    return result
+
+# Reconciles the posts of tenant, before its outbox is written, if
+# RECONCILE_ON_START is set or comments were left in the outbox. A comment
+# that was left there may have been created on Disqus by a sync that stopped
+# before it could record it, and must not be created again.
+def reconcile_on_start(tenant, store):
+    depth, _ = store.outbox_status(tenant.name, time.time())
+    if RECONCILE_ON_START or depth > 0:
+        reconcile(tenant.all_posts, tenant.source_apis, tenant.disqusApi, store)
+
+# Syncs every post once, and waits for the comments to be copied. Comments
+# that fail are left in the outbox for the next sync.
+def sync(all_posts, source_apis, outbox, store, params):
+    sync_jobs(make_jobs(all_posts, source_apis), source_apis, outbox, store, params)
+    outbox.drain()
+
+# Schedules the next poll of each of jobs, which were just synced.
+# copied: The result of sync_due_jobs for jobs. Jobs that could not be
+#         fetched are tried again after their usual interval.
+def reschedule_all(scheduler, jobs, copied):
+    for job, num_copied in zip(jobs, copied):
+        if num_copied is None:
+            scheduler.postpone(job, job.interval)
+        else:
+            scheduler.reschedule(job, num_copied)
+
+# Polls every post of every site on every website forever, as often as the
+# Scheduler decides based on how active each thread is.
 def loop(params):
-    all_posts = create_all_posts_data_structure(params)
+    store = open_store(params.debug)
+    tenants = open_tenants(store, params)
+    scheduler = make_scheduler(tenants)
+    for tenant in tenants:
+        reconcile_on_start(tenant, store)
+        for post, website in make_jobs(tenant.all_posts, tenant.source_apis):
+            scheduler.add(post, website, first_poll=SCHEDULER_FLOOR, site=tenant.name)
+        tenant.outbox.start()
+    start_webhook(params, scheduler, tenants)
     counter = 0
     while True:
+        with metrics.timer('stage_seconds', stage='wait'):
+            due = scheduler.wait_for_due_jobs()
+        if not due:
+            continue
         counter += 1
-        print 'Iteration', counter
-        sync(all_posts, params)
+        print 'Iteration', counter, 'polling', len(due), 'of', len(scheduler) + len(due), 'threads'
+        copied = profile_once(params, sync_due_jobs, due, tenants, store, params)
+        reschedule_all(scheduler, due, copied)
+        print 'EA Forum page cache:', tenants[0].source_apis[EA_FORUM_STRING].cache.report()
+        export_metrics(params, counter)
 
-        time.sleep(DELAY)
+# Like loop, but only syncs the posts that this worker holds leases on, so
+# that several workers can share the posts between them. Each worker must
+# have its own params.worker_id. When a worker takes over a post, it reloads
+# what other workers recorded about it and reconciles it with Disqus before
+# polling it or writing its comments from the outbox.
+def work(params):
+    store = open_store(params.debug)
+    tenants = open_tenants(store, params)
+    tenant_of_post = { post.disqus_id:tenant for tenant in tenants for post in tenant.all_posts }
+    leases = Leases(store, params.worker_id, [post.disqus_id for tenant in tenants
+                                              for post in tenant.all_posts])
+    leases.start()
+    for tenant in tenants:
+        tenant.outbox.start(leases)
+    scheduler = make_scheduler(tenants)
+    start_webhook(params, scheduler, tenants)
+    jobs_by_post = {}
+    counter = 0
+    try:
+        while True:
+            acquired, lost = leases.changes()
+            for post_id in lost:
+                for job in jobs_by_post.pop(post_id, []):
+                    scheduler.cancel(job)
+            if acquired:
+                print 'Worker', params.worker_id, 'took over', len(acquired), 'posts'
+            for tenant in tenants:
+                posts = [tenant.all_posts.get(post_id) for post_id in sorted(acquired)
+                         if tenant_of_post[post_id] is tenant]
+                if not posts:
+                    continue
+                try:
+                    with tenant.outbox.lock:
+                        for post in posts:
+                            store.reload_post(post)
+                    reconcile(posts, tenant.source_apis, tenant.disqusApi, store)
+                except Exception as e:
+                    # They are not synced until this works on a later pass
+                    print 'Failed to take over', len(posts), 'posts of site', tenant.name, '-', e
+                    metrics.count('takeover_failures', site=tenant.name)
+                    leases.retry_acquired([post.disqus_id for post in posts])
+                    continue
+                leases.mark_ready([post.disqus_id for post in posts])
+                # Their queued comments can be written now
+                tenant.outbox.wake.set()
+                for post, website in make_jobs(posts, tenant.source_apis):
+                    job = scheduler.add(post, website, first_poll=SCHEDULER_FLOOR, site=tenant.name)
+                    jobs_by_post.setdefault(post.disqus_id, []).append(job)
+            # The workers share the Disqus quota
+            for tenant in tenants:
+                tenant.disqusApi.rate_limiter.set_share(1.0 / leases.live_workers)
+
+            with metrics.timer('stage_seconds', stage='wait'):
+                due = scheduler.wait_for_due_jobs(LEASE_RENEW_INTERVAL)
+            ready = []
+            for job in due:
+                if leases.begin(job.post.disqus_id):
+                    ready.append(job)
+                elif leases.owns(job.post.disqus_id):
+                    # The lease is about to be renewed
+                    scheduler.postpone(job, SCHEDULER_FLOOR)
+            if not ready:
+                continue
+            counter += 1
+            print 'Iteration', counter, 'polling', len(ready), 'threads'
+            try:
+                copied = profile_once(params, sync_due_jobs, ready, tenants, store, params)
+            finally:
+                for job in ready:
+                    leases.end(job.post.disqus_id)
+            reschedule_all(scheduler, ready, copied)
+            export_metrics(params, counter)
+    finally:
+        for tenant in tenants:
+            tenant.outbox.stop()
+        leases.stop()
 
 def usage_str():
     result = 'Supported commands:\n'
     result += 'disqus-ids: Get the recent post ids and titles from Disqus\n'
-    result += 'go: Run the main loop that syncs comments every 5 minutes\n'
+    result += 'reconcile: Rebuild the record of copied comments from Disqus\n'
+    result += 'go: Run the main loop that syncs comments as they arrive\n'
+    result += 'plan: Print (as JSON) what a sync would copy, and the Disqus requests and time it would take\n'
+    result += 'worker: Like go, but share the posts with the other running workers\n'
     result += 'refresh-fb: Get a new Facebook access code\n'
     result += 'refresh-disqus: Get a new Disqus access code\n'
     return result
@@ -121,31 +531,77 @@ result = 0
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Copy comments from posts to blog.', epilog=usage_str())
     parser.add_argument('command', nargs=1,
-                        choices=['sync', 'go', 'refresh-fb', 'refresh-disqus', 'disqus-ids', 'fb-posts', 'test'])
+                        choices=['sync', 'go', 'plan', 'refresh-fb', 'refresh-disqus', 'disqus-ids', 'fb-posts', 'reconcile', 'worker', 'test'])
     parser.add_argument('--debug', action='store_true',
                         help='Run in debug mode, printing all actions that would be taken, but not actually performing them')
     parser.add_argument('--prefer_user_post_data', action='store_true',
-                        help='When the pickle file and the user post data conflict, use the results from the user post data rather than raising an error.')
+                        help='When the saved state and the user post data conflict, use the results from the user post data rather than raising an error.')
+    parser.add_argument('--metrics', default=METRICS_FILE,
+                        help='Where to write metrics after each sync; a name ending in .jsonl gets JSON lines instead of the Prometheus text format')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the first sync iteration (in the main thread) and save the profile to FILE')
+    parser.add_argument('--site',
+                        help='Only sync the site with this name in %s' % SITES_FILE)
+    parser.add_argument('--webhook', type=int, metavar='PORT',
+                        help='For go and worker, sync threads as soon as a webhook on PORT says they have new comments')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Make disqus-ids and fb-posts ask the APIs, even if they were asked recently')
+    parser.add_argument('--lines', action='store_true',
+                        help='Make disqus-ids print each post as an "id title" line as it is listed, instead of printing a list of (id, title) pairs at the end')
+    parser.add_argument('--worker-id', default='%s:%d' % (socket.gethostname(), os.getpid()),
+                        help='A name for this worker that no other running worker uses')
     params = parser.parse_args()
     command = params.command[0]
 
+    # The commands that talk to a single account use the first site, or the
+    # one named by --site
+    site = select_sites(params)[0]
+    response_cache = None if params.no_cache else ResponseCache()
+
     if command == 'refresh-fb':
-        result = FacebookAPI(params.debug).get_access_token()
+        result = site.make_facebook_api(params.debug).get_access_token()
         print result
-        print 'Put this in FB_LONG_CODE in keys.py and restart'
+        print 'Put this in FB_LONG_CODE in keys.py (or access_token in %s) and restart' % SITES_FILE
     elif command == 'refresh-disqus':
-        result = DisqusAPI(params.debug).get_access_token()
+        result = site.make_disqus_api(params.debug, {}).get_access_token()
         print result
-        print 'Put this in DISQUS_ADMIN_ACCESS_TOKEN in keys.py and restart'
+        print 'Put this in DISQUS_ADMIN_ACCESS_TOKEN in keys.py (or admin_access_token in %s) and restart' % SITES_FILE
     elif command == 'go':
         loop(params)
+    elif command == 'worker':
+        work(params)
     elif command == 'sync':
-        sync(create_all_posts_data_structure(params), params)
+        store = open_store(params.debug)
+        tenants = open_tenants(store, params)
+        for tenant in tenants:
+            reconcile_on_start(tenant, store)
+            profile_once(params, sync, tenant.all_posts, tenant.source_apis, tenant.outbox, store, params)
+        export_metrics(params)
+    elif command == 'plan':
+        # Nothing is written to the state file or the page cache
+        store = open_store(True, read_only=True)
+        # Only the plan goes to stdout, so that it can be read as JSON
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            result = plan(open_tenants(store, params, PageCache(read_only=True)), store, params)
+        finally:
+            sys.stdout = stdout
+        print json.dumps(result, indent=2, sort_keys=True)
+    elif command == 'reconcile':
+        store = open_store(params.debug)
+        result = sum(reconcile(tenant.all_posts, tenant.source_apis, tenant.disqusApi, store)
+                     for tenant in open_tenants(store, params))
     elif command == 'disqus-ids':
-        result = DisqusAPI(params.debug).get_post_ids_and_titles()
-        print result
+        posts = site.make_disqus_api(params.debug, {}, response_cache).get_post_ids_and_titles()
+        if params.lines:
+            for post_id, title in posts:
+                print post_id, title.encode('utf-8')
+        else:
+            result = list(posts)
+            print result
     elif command == 'fb-posts':
-        result = FacebookAPI(params.debug).get_posts()
+        result = site.make_facebook_api(params.debug, response_cache).get_posts()
         for post in result:
             print post
     elif command == 'test':
@@ -0,0 +1,141 @@
+import threading, time
+from config import *
+from metrics import metrics
+
+# The leases that one worker holds on posts, so that several workers can sync
+# disjoint sets of posts at the same time. A background thread renews them
+# every LEASE_RENEW_INTERVAL seconds through the store, taking free posts up
+# to a fair share and giving up posts beyond it. When a worker dies its
+# leases expire after LEASE_DURATION seconds and the others take its posts.
+# Posts are only given up while no sync of them is running (see begin), and
+# a post is only synced while its lease has more than LEASE_MARGIN seconds
+# left, so two workers never sync the same post at the same time. A post that
+# was just taken over is not synced until the worker has reloaded and
+# reconciled it (see mark_ready), since the previous owner may have created
+# comments on Disqus that it never recorded.
+class Leases:
+    # store: The Store that the leases are kept in, shared by every worker.
+    # worker_id: A name for this worker that no other worker uses.
+    # post_ids: The disqus_id of every post to be synced.
+    def __init__(self,
+                 store,
+                 worker_id,
+                 post_ids,
+                 duration=LEASE_DURATION,
+                 renew_interval=LEASE_RENEW_INTERVAL,
+                 margin=LEASE_MARGIN):
+        self.store = store
+        self.worker_id = worker_id
+        self.post_ids = post_ids
+        self.duration = duration
+        self.renew_interval = renew_interval
+        self.margin = margin
+        self.lock = threading.Lock()
+        # The posts we hold, and when their leases expire
+        self.owned = set()
+        self.expires = 0
+        # How many syncs of each post are running
+        self.busy = {}
+        # The owned posts that have been reloaded and reconciled since they
+        # were taken over
+        self.ready = set()
+        self.live_workers = 1
+        self.share = None
+        # Changes since the last call to changes
+        self.acquired = set()
+        self.lost = set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Takes the first leases, and then keeps renewing them in the background.
+    def start(self):
+        self.renew()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.renew_interval):
+            try:
+                self.renew()
+            except Exception as e:
+                # The leases run out if this keeps failing, which is safe
+                print 'Failed to renew leases:', e
+
+    def renew(self):
+        with self.lock:
+            release = []
+            if self.share is not None and len(self.owned) > self.share:
+                idle = sorted(p for p in self.owned if p not in self.busy)
+                release = idle[:len(self.owned) - self.share]
+                self.owned.difference_update(release)
+                self.ready.difference_update(release)
+                self.lost.update(release)
+        owned, expires, live_workers, share = self.store.renew_leases(
+            self.worker_id, self.post_ids, release, self.duration)
+        with self.lock:
+            owned = set(owned)
+            self.lost.update(self.owned - owned)
+            self.acquired.update(owned - self.owned)
+            self.owned = owned
+            self.ready &= owned
+            self.expires = expires
+            self.live_workers = live_workers
+            self.share = share
+        metrics.set('leases_held', len(owned))
+        metrics.set('live_workers', live_workers)
+
+    # Stops renewing, and gives up every lease so others can take over now.
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.store.release_leases(self.worker_id)
+
+    # Returns: The ids of the posts that were acquired and the ids of the
+    #          posts that were lost since the last call. A post can be in
+    #          both if it was lost and taken again, in which case another
+    #          worker may have synced it in between.
+    def changes(self):
+        with self.lock:
+            changes = (self.acquired, self.lost)
+            self.acquired = set()
+            self.lost = set()
+            return changes
+
+    # Reports the posts with ids post_ids as acquired again by the next call
+    # to changes, for when they could not be reloaded or reconciled. Posts
+    # that are no longer ours are left out.
+    def retry_acquired(self, post_ids):
+        with self.lock:
+            self.acquired.update(p for p in post_ids if p in self.owned)
+
+    def owns(self, post_id):
+        with self.lock:
+            return post_id in self.owned
+
+    # Lets the posts with ids post_ids be synced, once they have been reloaded
+    # and reconciled after being reported by changes. Posts that were lost
+    # again since then are left alone, as they need to be reloaded again.
+    def mark_ready(self, post_ids):
+        with self.lock:
+            self.ready.update(p for p in post_ids if p in self.owned and p not in self.lost)
+
+    def holds(self, post_id):
+        with self.lock:
+            return post_id in self.ready and time.time() < self.expires - self.margin
+
+    # Marks a sync of post_id as running, so that it is not given up.
+    # Returns: Whether the sync may go ahead; if not, end must not be called.
+    def begin(self, post_id):
+        with self.lock:
+            if post_id not in self.ready or time.time() >= self.expires - self.margin:
+                return False
+            self.busy[post_id] = self.busy.get(post_id, 0) + 1
+            return True
+
+    def end(self, post_id):
+        with self.lock:
+            self.busy[post_id] -= 1
+            if self.busy[post_id] == 0:
+                del self.busy[post_id]
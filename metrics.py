@@ -0,0 +1,140 @@
+import json, os, threading, time
+from contextlib import contextmanager
+from functools import wraps
+from config import *
+
+# Counts, gauges and latency histograms for the hot paths of a sync, so that
+# a slow iteration can be traced to the scraping, the API calls, the writes to
+# Disqus or the store. Each metric has a name and optionally some labels,
+# given as keyword arguments. Safe to share between threads.
+class Metrics:
+    # Upper bounds (in seconds) of the latency histogram buckets
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # Maps each key to [bucket counts, sum, count]
+        self.histograms = {}
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, n=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    # Times the body of a with statement, whether or not it raises.
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    # Decorator that times every call of a function.
+    def timed(self, name, **labels):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Returns: The total of counter name over all of its labels.
+    def total(self, name):
+        with self.lock:
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    # Returns: The total time recorded in histogram name with exactly the
+    # given labels.
+    def seconds(self, name, **labels):
+        with self.lock:
+            histogram = self.histograms.get(self.key(name, labels))
+            return histogram[1] if histogram is not None else 0.0
+
+    def format_labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+    # Returns: Every metric in the Prometheus text exposition format.
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for kind, values in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted(set(n for n, _ in values)):
+                    lines.append('# TYPE %s%s %s' % (self.prefix, name, kind))
+                    for (n, labels), value in sorted(values.items()):
+                        if n == name:
+                            lines.append('%s%s%s %s' % (self.prefix, name, self.format_labels(labels), value))
+            for name in sorted(set(n for n, _ in self.histograms)):
+                lines.append('# TYPE %s%s histogram' % (self.prefix, name))
+                for (n, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, bucket in zip(self.BUCKETS, buckets):
+                        lines.append('%s%s_bucket%s %d' % (self.prefix, name,
+                                     self.format_labels(labels, [('le', bound)]), bucket))
+                    lines.append('%s%s_bucket%s %d' % (self.prefix, name,
+                                 self.format_labels(labels, [('le', '+Inf')]), count))
+                    lines.append('%s%s_sum%s %f' % (self.prefix, name, self.format_labels(labels), total))
+                    lines.append('%s%s_count%s %d' % (self.prefix, name, self.format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    # Returns: Every metric as a dictionary that can be converted to JSON.
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': { n + self.format_labels(l):v for (n, l), v in self.counters.items() },
+                'gauges': { n + self.format_labels(l):v for (n, l), v in self.gauges.items() },
+                'histograms': { n + self.format_labels(l):{ 'sum': h[1], 'count': h[2],
+                                                             'buckets': dict(zip(self.BUCKETS, h[0])) }
+                                for (n, l), h in self.histograms.items() }
+            }
+
+    # Writes every metric to filename. A filename ending in .jsonl gets one
+    # JSON line appended per call; anything else is overwritten with the
+    # Prometheus text format, which the node_exporter textfile collector can
+    # pick up.
+    # iteration: The number of the sync iteration, included in JSON lines.
+    def export(self, filename, iteration=None):
+        if filename.endswith('.jsonl'):
+            line = dict(self.snapshot(), time=time.time(), iteration=iteration)
+            with open(filename, 'a') as f:
+                f.write(json.dumps(line, sort_keys=True) + '\n')
+            return
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(temp_filename, filename)
+
+    # Returns: A one line summary of the totals.
+    def report(self):
+        return '%d requests, %d bytes downloaded, %d comments copied' % (
+            self.total('requests'), self.total('response_bytes'), self.total('comments_copied'))
+
+# Shared by everything that records metrics.
+metrics = Metrics()
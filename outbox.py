@@ -0,0 +1,172 @@
+import threading, time
+from multiprocessing.pool import ThreadPool
+from config import *
+from metrics import metrics
+
+# The comments of one site that are waiting to be created on Disqus, kept in
+# the store so that nothing planned is lost in a crash. Syncs queue comments
+# with enqueue and go on fetching, and a writer (drain, or the thread started
+# by start) creates them as fast as the Disqus rate limits allow.
+# A reply is only created once the comment it replies to has been, and a
+# comment that fails is retried with exponential backoff without holding up
+# the others. Threads are written in parallel, and the comments of a thread
+# in order, except that a thread with at least BACKFILL_THRESHOLD comments
+# queued has them written in parallel too.
+# The number of queued comments is exported as the outbox_depth gauge.
+class Outbox:
+    # disqus_api: The DisqusAPI for the site's forum.
+    # all_posts: The PostIndex of the site's posts, whose copied_comments
+    #            are updated as comments are created.
+    def __init__(self, store, disqus_api, all_posts, site=DEFAULT_SITE, concurrency=OUTBOX_CONCURRENCY):
+        self.store = store
+        self.disqus_api = disqus_api
+        self.all_posts = all_posts
+        self.site = site
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.leases = None
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Queues the comments that are not yet on Disqus.
+    # comments: A list of (comment, parent_id) pairs, as for
+    #           Store.enqueue_comments, with every comment after the one it
+    #           replies to.
+    # Returns: How many comments were newly queued.
+    def enqueue(self, post, website, comments):
+        if not comments:
+            return 0
+        if self.store.debug:
+            # Nothing is saved in debug mode, so write them straight away
+            for comment, parent_id in comments:
+                self.send(post, website, comment, parent_id)
+            return len(comments)
+        added = self.store.enqueue_comments(self.site, post, website, comments)
+        self.update_depth()
+        self.wake.set()
+        return added
+
+    # Writes the queue in the background until stop is called.
+    # leases: If given, only comments on posts that it holds are written.
+    def start(self, leases=None):
+        self.leases = leases
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                print 'Failed to write the outbox:', e
+            # Comments that are due now but were not written are waiting for
+            # their parents, and are woken up with them
+            now = time.time()
+            depth, retry = self.store.outbox_status(self.site, now)
+            timeout = OUTBOX_POLL_INTERVAL
+            if retry is not None:
+                timeout = min(timeout, retry - now)
+            self.wake.wait(timeout)
+            self.wake.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def update_depth(self):
+        depth, _ = self.store.outbox_status(self.site, time.time())
+        metrics.set('outbox_depth', depth, site=self.site)
+
+    # Writes every queued comment that is due and whose parent is on Disqus,
+    # round after round until none are left, then approves them.
+    # Returns: How many comments were created.
+    def drain(self):
+        sent = 0
+        # Threads in which a comment failed, which wait for the next drain
+        # so that their comments stay in order
+        failed = set()
+        pool = ThreadPool(self.concurrency)
+        try:
+            while True:
+                tasks = self.ready_tasks(failed)
+                if not tasks:
+                    break
+                with metrics.timer('stage_seconds', stage='copy'):
+                    results = pool.map(self.send_all, tasks)
+                for task, (num_sent, ok) in zip(tasks, results):
+                    sent += num_sent
+                    if not ok:
+                        post, website = task[0][:2]
+                        failed.add((post.disqus_id, website))
+        finally:
+            pool.close()
+            with metrics.timer('stage_seconds', stage='approve'):
+                self.disqus_api.flush_approvals()
+            self.update_depth()
+        return sent
+
+    # Returns: The queued comments that can be written now, as a list of
+    #          tasks that can run in parallel, each a list of (post, website,
+    #          comment, parent_id, attempts) tuples to be written in order.
+    # failed: The (post_id, website) pairs to leave out.
+    def ready_tasks(self, failed):
+        threads = {}
+        for post_id, website, comment, parent_id, attempts in self.store.load_outbox(self.site, time.time()):
+            post = self.all_posts.get(post_id)
+            if post is None or (post_id, website) in failed:
+                continue
+            if self.leases is not None and not self.leases.holds(post_id):
+                continue
+            copied_comments = post.copied_comments.setdefault(website, {})
+            if comment.id in copied_comments:
+                # Created before, for instance by a worker that died before
+                # it could take it out of the queue, and found by reconcile
+                self.store.remove_from_outbox(post_id, website, comment.id)
+            elif parent_id is None or parent_id in copied_comments:
+                threads.setdefault((post_id, website), []).append(
+                    (post, website, comment, parent_id, attempts))
+        tasks = []
+        for _, entries in sorted(threads.items()):
+            if len(entries) >= BACKFILL_THRESHOLD:
+                tasks.extend([entry] for entry in entries)
+            else:
+                tasks.append(entries)
+        return tasks
+
+    # Writes the comments of a task in order, stopping at the first failure.
+    # Returns: How many were written, and whether all of them were.
+    def send_all(self, task):
+        sent = 0
+        for post, website, comment, parent_id, attempts in task:
+            if self.leases is not None and not self.leases.begin(post.disqus_id):
+                return sent, True
+            try:
+                self.send(post, website, comment, parent_id)
+            except Exception as e:
+                print 'Failed to copy comment', comment.id, 'on post', post.disqus_id, '-', e
+                metrics.count('outbox_failures', source=website)
+                delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_INITIAL_BACKOFF * 2 ** attempts)
+                self.store.record_send_failure(post.disqus_id, website, comment.id, time.time() + delay)
+                return sent, False
+            finally:
+                if self.leases is not None:
+                    self.leases.end(post.disqus_id)
+            sent += 1
+        return sent, True
+
+    # Creates comment on Disqus and records it.
+    # parent_id: The id of the comment it replies to, which must be copied.
+    def send(self, post, website, comment, parent_id):
+        copied_comments = post.copied_comments.setdefault(website, {})
+        disqus_parent = copied_comments[parent_id] if parent_id is not None else None
+        disqus_id = self.disqus_api.guarded_make_comment(comment, post.disqus_id, disqus_parent)
+        with self.lock:
+            # Looked up again, since the post may have been reloaded (under
+            # self.lock) in the meantime
+            post.copied_comments.setdefault(website, {})[comment.id] = disqus_id
+            self.store.record_sent(post, website, comment.id, disqus_id)
+        metrics.count('comments_copied', source=website)
@@ -0,0 +1,167 @@
+import heapq, random, threading, time
+from api import TokenBucket
+from config import *
+
+# Polling one website for comments on one post of site.
+class Job:
+    def __init__(self, post, website, interval, site=DEFAULT_SITE):
+        self.post = post
+        self.website = website
+        self.site = site
+        # Seconds between the last poll and the next one
+        self.interval = interval
+        self.next_poll = 0
+        self.last_poll = None
+        # Cancelled jobs are dropped when they come due
+        self.cancelled = False
+        # Whether the job is waiting in the scheduler, rather than being
+        # polled
+        self.scheduled = False
+        # Set when the job is triggered while it is being polled, so that it
+        # is polled again as soon as it is back
+        self.triggered = False
+
+    def __str__(self):
+        return '%s on %s every %ds' % (self.post.disqus_id, self.website, self.interval)
+
+# Decides when to poll each job, based on how fast comments are arriving.
+# A job that finds new comments is polled again after between floor and
+# initial seconds, sooner the faster the comments came in. Each poll that
+# finds nothing multiplies the wait by backoff, up to ceiling, so threads that
+# have gone quiet cost less and less.
+# Each site can be given a budget of polls per hour. Jobs of a site that has
+# used up its budget wait until it allows another poll, so one site cannot
+# crowd out the others.
+# Jobs can also be triggered from other threads, for instance when a webhook
+# says that a thread has new comments, which makes them due at once.
+class Scheduler:
+    def __init__(self,
+                 initial=DELAY,
+                 floor=SCHEDULER_FLOOR,
+                 ceiling=SCHEDULER_CEILING,
+                 backoff=SCHEDULER_BACKOFF):
+        self.initial = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.heap = []
+        self.counter = 0
+        self.budgets = {}
+        # Maps (site, post.disqus_id, website) to the job for it
+        self.jobs = {}
+        # Guards everything above, and wakes up wait_for_due_jobs when a job
+        # is triggered
+        self.condition = threading.Condition()
+
+    # Allows site to poll polls_per_hour times an hour, in bursts of up to
+    # burst polls.
+    def set_budget(self, site, polls_per_hour, burst=SITE_POLL_BURST):
+        self.budgets[site] = TokenBucket(polls_per_hour / 3600.0, burst)
+
+    # Must be called with self.condition held. A job that is pushed again
+    # before it comes due leaves a stale entry behind, which is skipped when
+    # it comes up because its time is no longer the job's next_poll.
+    def push(self, job):
+        if job.triggered:
+            job.triggered = False
+            job.next_poll = time.time()
+        job.scheduled = True
+        # The counter breaks ties, so jobs themselves are never compared
+        self.counter += 1
+        heapq.heappush(self.heap, (job.next_poll, self.counter, job))
+
+    def is_stale(self, entry):
+        when, _, job = entry
+        return job.cancelled or not job.scheduled or when != job.next_poll
+
+    # Adds a job for post and website. The first poll happens within
+    # first_poll seconds, spread out so that jobs do not all start at once.
+    def add(self, post, website, first_poll=0, site=DEFAULT_SITE):
+        job = Job(post, website, self.initial, site)
+        job.next_poll = time.time() + random.uniform(0, first_poll)
+        with self.condition:
+            self.jobs[(site, post.disqus_id, website)] = job
+            self.push(job)
+        return job
+
+    def __len__(self):
+        with self.condition:
+            return sum(1 for job in self.jobs.values() if job.scheduled)
+
+    # Stops polling job.
+    def cancel(self, job):
+        with self.condition:
+            job.cancelled = True
+            key = (job.site, job.post.disqus_id, job.website)
+            if self.jobs.get(key) is job:
+                del self.jobs[key]
+
+    # Makes the jobs for the post with Disqus id disqus_id due now, or as soon
+    # as they are back if they are being polled. Safe to call from any thread.
+    # website: The website to poll, or None for every website of the post.
+    # Returns: How many jobs were triggered.
+    def trigger(self, site, disqus_id, website=None):
+        with self.condition:
+            jobs = [job for (job_site, job_post, job_website), job in self.jobs.items()
+                    if job_site == site and job_post == disqus_id
+                    and website in [None, job_website]]
+            now = time.time()
+            for job in jobs:
+                if not job.scheduled:
+                    job.triggered = True
+                elif job.next_poll > now:
+                    job.next_poll = now
+                    self.push(job)
+            self.condition.notify_all()
+            return len(jobs)
+
+    # Sleeps until at least one job is due, or for at most timeout seconds.
+    # Returns: The list of all jobs that are due, which are no longer
+    #          scheduled until they are passed to reschedule or postpone.
+    # Returns early, possibly with no jobs, if a job is triggered.
+    def wait_for_due_jobs(self, timeout=None):
+        with self.condition:
+            while self.heap and self.is_stale(self.heap[0]):
+                heapq.heappop(self.heap)
+            delay = self.heap[0][0] - time.time() if self.heap else self.initial
+            if timeout is not None:
+                delay = min(delay, timeout)
+            if delay > 0:
+                self.condition.wait(delay)
+            now = time.time()
+            jobs = []
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                if self.is_stale(entry):
+                    continue
+                job = entry[2]
+                job.scheduled = False
+                wait = self.budgets[job.site].try_acquire() if job.site in self.budgets else 0
+                if wait > 0:
+                    self.postpone(job, wait)
+                else:
+                    jobs.append(job)
+            return jobs
+
+    # Polls job again after delay seconds, without changing its interval.
+    def postpone(self, job, delay):
+        with self.condition:
+            job.next_poll = time.time() + delay
+            self.push(job)
+
+    # Schedules the next poll of a job that was just polled.
+    # new_comments: How many new comments the poll found.
+    def reschedule(self, job, new_comments):
+        now = time.time()
+        if new_comments > 0:
+            elapsed = now - job.last_poll if job.last_poll is not None else self.initial
+            # Expect the next comment after about half the time it took each
+            # of these to arrive.
+            job.interval = elapsed / (2.0 * new_comments)
+            job.interval = max(self.floor, min(self.initial, job.interval))
+        else:
+            job.interval = min(self.ceiling, job.interval * self.backoff)
+        job.last_poll = now
+        job.next_poll = now + job.interval
+        with self.condition:
+            self.push(job)
@@ -0,0 +1,117 @@
+import json, os.path
+from api import DisqusAPI, EAForumAPI, FacebookAPI, RateLimiter
+from config import *
+
+# A blog whose comments we sync: the Disqus forum that comments are copied to,
+# the accounts they are copied from and the file listing its posts.
+# SITES_FILE holds a list of sites, each like this (facebook, ea_forum and
+# budget may be left out):
+#
+#   {
+#     "name": "rohin",
+#     "posts_file": "post_data.json",
+#     "disqus": {"forum_name": "...", "global_key": "...", "app_key": "...",
+#                "app_secret": "...", "owner_access_token": "...",
+#                "admin_access_token": "..."},
+#     "facebook": {"app_id": "...", "app_secret": "...", "user_id": "...",
+#                  "access_token": "..."},
+#     "ea_forum": {"owner": "rohinmshah"},
+#     "budget": 3600
+#   }
+#
+# The disqus and facebook entries are passed on to DisqusAPI and FacebookAPI,
+# and budget is how many polls the site may make per hour. Every field of
+# disqus, and of facebook if it is given, must be set: nothing is taken from
+# keys.py, which holds the keys of another blog. A site without facebook is
+# not synced from Facebook.
+class Site:
+    DISQUS_FIELDS = ['forum_name', 'global_key', 'app_key', 'app_secret',
+                     'owner_access_token', 'admin_access_token']
+    FACEBOOK_FIELDS = ['app_id', 'app_secret', 'user_id', 'access_token']
+
+    def __init__(self, name, posts_file, disqus, facebook=None, ea_forum_owner=EA_FORUM_OWNER,
+                 budget=SITE_POLL_BUDGET):
+        for fields, given in [(self.DISQUS_FIELDS, disqus), (self.FACEBOOK_FIELDS, facebook)]:
+            if given is None:
+                continue
+            unknown = set(given) - set(fields)
+            if unknown:
+                raise ValueError('Unknown settings for site %s: %s' % (name, ', '.join(sorted(unknown))))
+            missing = set(fields) - set(given)
+            if missing:
+                raise ValueError('Missing settings for site %s: %s' % (name, ', '.join(sorted(missing))))
+        self.name = name
+        self.posts_file = posts_file
+        self.disqus = disqus
+        self.facebook = facebook
+        self.ea_forum_owner = ea_forum_owner
+        self.budget = budget
+
+    # Returns: A DisqusAPI for the site's forum. Sites that use the same
+    # Disqus keys share a RateLimiter, since Disqus counts their requests
+    # together.
+    # rate_limiters: A dictionary of the RateLimiters made so far, which the
+    #                new one is added to.
+    # response_cache: As for DisqusAPI.
+    def make_disqus_api(self, debug, rate_limiters, response_cache=None):
+        key = tuple(self.disqus.get(field) for field in ['global_key', 'app_key', 'admin_access_token'])
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(DISQUS_RATE_LIMITS, DISQUS_MAX_RETRIES, DISQUS_INITIAL_BACKOFF)
+        return DisqusAPI(debug, rate_limiter=rate_limiters[key], response_cache=response_cache, **self.disqus)
+
+    # Returns: A FacebookAPI for the site's Facebook account.
+    # response_cache: As for FacebookAPI.
+    def make_facebook_api(self, debug, response_cache=None):
+        if self.facebook is None:
+            raise ValueError('Site %s has no Facebook account' % self.name)
+        return FacebookAPI(debug, response_cache=response_cache, **self.facebook)
+
+    # Returns: A dictionary mapping each website that the site's comments are
+    # read from to the API object that reads them. Facebook is left out if
+    # the site has no Facebook account.
+    # cache: The PageCache for scraped pages, shared by all sites.
+    def make_source_apis(self, debug, cache):
+        source_apis = { EA_FORUM_STRING: EAForumAPI(debug, cache=cache, owner=self.ea_forum_owner) }
+        if self.facebook is not None:
+            source_apis[FACEBOOK_STRING] = self.make_facebook_api(debug)
+        return source_apis
+
+# Returns: The single site used when there is no SITES_FILE, set up from
+# keys.py.
+def default_site():
+    import keys
+    return Site(DEFAULT_SITE, USER_POSTS_FILE, {
+        'forum_name': keys.DISQUS_FORUM_NAME,
+        'global_key': keys.DISQUS_GLOBAL_KEY,
+        'app_key': keys.DISQUS_PUBLIC_KEY,
+        'app_secret': keys.DISQUS_SECRET,
+        'owner_access_token': keys.DISQUS_OWNER_ACCESS_TOKEN,
+        'admin_access_token': keys.DISQUS_ADMIN_ACCESS_TOKEN
+    }, {
+        'app_id': keys.FB_APP_ID,
+        'app_secret': keys.FB_APP_SECRET,
+        'user_id': keys.FB_OWNER_ID,
+        'access_token': keys.FB_LONG_CODE
+    })
+
+# Returns: The list of sites in filename, or the default site if there is no
+# such file.
+def load_sites(filename=SITES_FILE):
+    if not os.path.isfile(filename):
+        return [default_site()]
+    with open(filename) as f:
+        site_dicts = json.load(f)
+    sites = []
+    for site_dict in site_dicts:
+        if 'name' not in site_dict or 'posts_file' not in site_dict or 'disqus' not in site_dict:
+            raise ValueError('Every site in %s needs a name, posts_file and disqus' % filename)
+        sites.append(Site(site_dict['name'],
+                          site_dict['posts_file'],
+                          site_dict['disqus'],
+                          site_dict.get('facebook'),
+                          site_dict.get('ea_forum', {}).get('owner', EA_FORUM_OWNER),
+                          site_dict.get('budget', SITE_POLL_BUDGET)))
+    names = [site.name for site in sites]
+    if len(set(names)) != len(names):
+        raise ValueError('Site names in %s must be unique' % filename)
+    return sites
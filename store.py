@@ -0,0 +1,430 @@
+import json, math, os, pickle, shutil, sqlite3, tempfile, threading, time
+from adts import Post, RealComment
+from config import *
+from metrics import metrics
+
+# Persistent record of the posts we sync and of which comments have already
+# been copied to Disqus. Every write is a single small record, so copying one
+# comment costs the same amount of disk I/O no matter how many posts and
+# comments we are tracking.
+# Subclasses implement the actual storage; see open_store for the one in use.
+class Store:
+    def __init__(self, debug):
+        self.debug = debug
+
+    # Returns: A list of Post objects, with copied_comments filled in.
+    def load_posts(self):
+        raise NotImplementedError
+
+    # Records the links (disqus_id and other_ids) of every post in posts.
+    def save_posts(self, posts):
+        raise NotImplementedError
+
+    # Records every post in posts along with all of its copied_comments.
+    def import_posts(self, posts):
+        raise NotImplementedError
+
+    # Replaces post.copied_comments and post.high_water with what is recorded,
+    # which may have been changed by another process since post was loaded.
+    def reload_post(self, post):
+        raise NotImplementedError
+
+    # Records that comments were copied to Disqus.
+    # comments: A list of (post, website, comment_id, disqus_id) tuples, each
+    #           saying that the comment with id comment_id on website was
+    #           copied to Disqus as disqus_id, on the blog post post.
+    def record_comments(self, comments):
+        raise NotImplementedError
+
+    # Returns: A dictionary mapping the disqus_id of each post that has been
+    #          reconciled to the createdAt of the newest Disqus comment seen.
+    def load_reconcile_marks(self):
+        raise NotImplementedError
+
+    def record_reconcile_mark(self, post, newest):
+        raise NotImplementedError
+
+    # Records post.high_water[website][thread_id].
+    def record_high_water(self, post, website, thread_id):
+        raise NotImplementedError
+
+    # Returns: The ids of the Disqus comments on the forum of site that are
+    #          waiting to be approved.
+    def load_pending_approvals(self, site=DEFAULT_SITE):
+        raise NotImplementedError
+
+    def add_pending_approval(self, comment_id, site=DEFAULT_SITE):
+        raise NotImplementedError
+
+    def remove_pending_approvals(self, comment_ids):
+        raise NotImplementedError
+
+    # Queues comments to be created on Disqus by an Outbox. A comment is
+    # identified by its post, website and id, and queueing one that is
+    # already queued does nothing, so the same comments can be queued again
+    # safely.
+    # comments: A list of (comment, parent_id) pairs, where comment is a
+    #           RealComment on website and parent_id is the id of the comment
+    #           on website that it replies to, or None.
+    # Returns: How many of the comments were not queued already.
+    def enqueue_comments(self, site, post, website, comments):
+        raise NotImplementedError
+
+    # Returns: The comments of site in the outbox whose next attempt is due by
+    #          now, in the order they were queued, as (post_id, website,
+    #          comment, parent_id, attempts) tuples.
+    def load_outbox(self, site, now):
+        raise NotImplementedError
+
+    # Returns: How many comments of site are in the outbox, and the earliest
+    #          time after now that one of them is due to be retried (or None).
+    def outbox_status(self, site, now):
+        raise NotImplementedError
+
+    # Records a queued comment as copied, as record_comments does, and takes
+    # it out of the outbox at the same time.
+    def record_sent(self, post, website, comment_id, disqus_id):
+        raise NotImplementedError
+
+    # Puts off the next attempt at a queued comment until next_attempt.
+    def record_send_failure(self, post_id, website, comment_id, next_attempt):
+        raise NotImplementedError
+
+    # Takes a comment out of the outbox without recording it as copied.
+    def remove_from_outbox(self, post_id, website, comment_id):
+        raise NotImplementedError
+
+    # Records that worker_id is alive, and renews its leases on posts.
+    # Workers whose heartbeat is older than duration are forgotten and their
+    # leases can be taken over. A worker takes unleased posts until it holds
+    # its fair share of all of them.
+    # post_ids: The disqus_id of every post to be synced.
+    # release: The ids of posts whose leases to give up.
+    # duration: How many seconds a lease lasts.
+    # Returns: A (posts, expires, live_workers, share) tuple, where posts is
+    #          the list of ids of the posts that worker_id now holds, expires
+    #          is the time that those leases expire, and share is the number
+    #          of posts each worker should hold.
+    def renew_leases(self, worker_id, post_ids, release, duration):
+        raise NotImplementedError
+
+    # Gives up all of the leases of worker_id.
+    def release_leases(self, worker_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class SqliteStore(Store):
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS posts (
+               disqus_id TEXT PRIMARY KEY,
+               other_ids TEXT NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS copied_comments (
+               post TEXT NOT NULL,
+               website TEXT NOT NULL,
+               comment_id TEXT NOT NULL,
+               disqus_id TEXT,
+               PRIMARY KEY (post, website, comment_id))''',
+        '''CREATE TABLE IF NOT EXISTS high_water (
+               post TEXT NOT NULL,
+               website TEXT NOT NULL,
+               thread_id TEXT NOT NULL,
+               mark TEXT NOT NULL,
+               PRIMARY KEY (post, website, thread_id))''',
+        '''CREATE TABLE IF NOT EXISTS pending_approvals (
+               comment_id TEXT PRIMARY KEY,
+               site TEXT NOT NULL DEFAULT '%s')''' % DEFAULT_SITE,
+        '''CREATE TABLE IF NOT EXISTS reconcile_marks (
+               post TEXT PRIMARY KEY,
+               newest TEXT NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS workers (
+               worker_id TEXT PRIMARY KEY,
+               heartbeat REAL NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS leases (
+               post TEXT PRIMARY KEY,
+               worker_id TEXT NOT NULL,
+               expires REAL NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS outbox (
+               post TEXT NOT NULL,
+               website TEXT NOT NULL,
+               comment_id TEXT NOT NULL,
+               parent_id TEXT,
+               comment TEXT NOT NULL,
+               site TEXT NOT NULL,
+               attempts INTEGER NOT NULL DEFAULT 0,
+               next_attempt REAL NOT NULL DEFAULT 0,
+               PRIMARY KEY (post, website, comment_id))'''
+    ]
+
+    # read_only: If set, the store works on a copy of filename in memory, so
+    #            that the file is not changed (nor created if it is missing).
+    #            This implies debug.
+    def __init__(self, debug, filename=STATE_DB_FILE, read_only=False):
+        Store.__init__(self, debug or read_only)
+        self.filename = filename
+        self.lock = threading.RLock()
+        if read_only:
+            # The connection may be used from several threads, one at a time
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+            if os.path.isfile(filename):
+                self.db.executescript('\n'.join(dump_copy(filename)))
+        else:
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            # WAL mode makes each commit a small append to the log instead of
+            # a rewrite, and a crash mid-write can never corrupt older records.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+            # Older versions had a single site
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(pending_approvals)')]
+            if 'site' not in columns:
+                self.db.execute("ALTER TABLE pending_approvals ADD COLUMN site TEXT NOT NULL DEFAULT '%s'"
+                                % DEFAULT_SITE)
+        # Leases are taken in explicit transactions, so they get their own
+        # connection that leaves transactions to us
+        self.lease_db = None
+
+    def load_posts(self):
+        posts = {}
+        for disqus_id, other_ids in self.db.execute('SELECT disqus_id, other_ids FROM posts'):
+            posts[disqus_id] = Post(disqus_id, json.loads(other_ids))
+        self.load_progress(posts, '', ())
+        return posts.values()
+
+    # Fills in copied_comments and high_water for posts.
+    # posts: A dictionary mapping disqus_id to Post objects.
+    # condition, parameters: Restricts which records are loaded.
+    def load_progress(self, posts, condition, parameters):
+        with self.lock:
+            rows = self.db.execute('SELECT post, website, comment_id, disqus_id FROM copied_comments' + condition,
+                                   parameters).fetchall()
+            marks = self.db.execute('SELECT post, website, thread_id, mark FROM high_water' + condition,
+                                    parameters).fetchall()
+        for post_id, website, comment_id, disqus_id in rows:
+            post = posts.get(post_id)
+            if post is None:
+                continue
+            post.copied_comments.setdefault(website, {})[comment_id] = disqus_id
+
+        for post_id, website, thread_id, mark in marks:
+            post = posts.get(post_id)
+            if post is None:
+                continue
+            post.high_water.setdefault(website, {})[thread_id] = json.loads(mark)
+
+    def reload_post(self, post):
+        post.copied_comments = { k:{} for k in post.other_ids }
+        post.high_water = { k:{} for k in post.other_ids }
+        self.load_progress({ post.disqus_id:post }, ' WHERE post = ?', (post.disqus_id,))
+
+    @metrics.timed('store_write_seconds', operation='save_posts')
+    def save_posts(self, posts):
+        if self.debug:
+            print 'Not saving posts since we are in debug mode'
+            return
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?)',
+                                [(p.disqus_id, json.dumps(p.other_ids)) for p in posts])
+
+    @metrics.timed('store_write_seconds', operation='import_posts')
+    def import_posts(self, posts):
+        self.save_posts(posts)
+        if self.debug:
+            return
+        with self.lock, self.db:
+            for post in posts:
+                for website, copied in post.copied_comments.items():
+                    self.db.executemany(
+                        'INSERT OR REPLACE INTO copied_comments VALUES (?, ?, ?, ?)',
+                        [(post.disqus_id, website, k, v) for k, v in copied.items()])
+
+    @metrics.timed('store_write_seconds', operation='record_comments')
+    def record_comments(self, comments):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO copied_comments VALUES (?, ?, ?, ?)',
+                                [(post.disqus_id, website, comment_id, disqus_id)
+                                 for post, website, comment_id, disqus_id in comments])
+
+    def load_reconcile_marks(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT post, newest FROM reconcile_marks'))
+
+    @metrics.timed('store_write_seconds', operation='record_reconcile_mark')
+    def record_reconcile_mark(self, post, newest):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO reconcile_marks VALUES (?, ?)',
+                            (post.disqus_id, newest))
+
+    @metrics.timed('store_write_seconds', operation='record_high_water')
+    def record_high_water(self, post, website, thread_id):
+        if self.debug:
+            return
+        mark = json.dumps(post.high_water[website][thread_id])
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO high_water VALUES (?, ?, ?, ?)',
+                            (post.disqus_id, website, thread_id, mark))
+
+    def load_pending_approvals(self, site=DEFAULT_SITE):
+        with self.lock:
+            rows = self.db.execute('SELECT comment_id FROM pending_approvals WHERE site = ? ORDER BY rowid',
+                                   (site,))
+            return [comment_id for (comment_id,) in rows]
+
+    @metrics.timed('store_write_seconds', operation='add_pending_approval')
+    def add_pending_approval(self, comment_id, site=DEFAULT_SITE):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO pending_approvals VALUES (?, ?)', (comment_id, site))
+
+    @metrics.timed('store_write_seconds', operation='remove_pending_approvals')
+    def remove_pending_approvals(self, comment_ids):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM pending_approvals WHERE comment_id = ?',
+                                [(comment_id,) for comment_id in comment_ids])
+
+    @metrics.timed('store_write_seconds', operation='enqueue_comments')
+    def enqueue_comments(self, site, post, website, comments):
+        if self.debug:
+            return len(comments)
+        rows = [(post.disqus_id, website, comment.id, parent_id,
+                 json.dumps([getattr(comment, field) for field in RealComment.__slots__]), site)
+                for comment, parent_id in comments]
+        with self.lock, self.db:
+            cursor = self.db.executemany('INSERT OR IGNORE INTO outbox (post, website, comment_id, parent_id, comment, site) '
+                                         'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            return cursor.rowcount
+
+    def load_outbox(self, site, now):
+        with self.lock:
+            rows = self.db.execute('SELECT post, website, comment, parent_id, attempts FROM outbox '
+                                   'WHERE site = ? AND next_attempt <= ? ORDER BY rowid', (site, now)).fetchall()
+        return [(post_id, website, RealComment(*json.loads(comment)), parent_id, attempts)
+                for post_id, website, comment, parent_id, attempts in rows]
+
+    def outbox_status(self, site, now):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*), MIN(CASE WHEN next_attempt > ? THEN next_attempt END) '
+                                   'FROM outbox WHERE site = ?', (now, site)).fetchone()
+
+    @metrics.timed('store_write_seconds', operation='record_sent')
+    def record_sent(self, post, website, comment_id, disqus_id):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO copied_comments VALUES (?, ?, ?, ?)',
+                            (post.disqus_id, website, comment_id, disqus_id))
+            self.db.execute('DELETE FROM outbox WHERE post = ? AND website = ? AND comment_id = ?',
+                            (post.disqus_id, website, comment_id))
+
+    @metrics.timed('store_write_seconds', operation='record_send_failure')
+    def record_send_failure(self, post_id, website, comment_id, next_attempt):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.execute('UPDATE outbox SET attempts = attempts + 1, next_attempt = ? '
+                            'WHERE post = ? AND website = ? AND comment_id = ?',
+                            (next_attempt, post_id, website, comment_id))
+
+    @metrics.timed('store_write_seconds', operation='remove_from_outbox')
+    def remove_from_outbox(self, post_id, website, comment_id):
+        if self.debug:
+            return
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM outbox WHERE post = ? AND website = ? AND comment_id = ?',
+                            (post_id, website, comment_id))
+
+    def renew_leases(self, worker_id, post_ids, release, duration):
+        with self.lock:
+            if self.lease_db is None:
+                self.lease_db = sqlite3.connect(self.filename, isolation_level=None,
+                                                check_same_thread=False)
+            db = self.lease_db
+            # Taking the write lock up front stops two workers from taking
+            # the same post
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                expires = now + duration
+                db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, now))
+                db.execute('DELETE FROM workers WHERE heartbeat < ?', (now - duration,))
+                db.execute('DELETE FROM leases WHERE expires < ?', (now,))
+                db.executemany('DELETE FROM leases WHERE post = ? AND worker_id = ?',
+                               [(post_id, worker_id) for post_id in release])
+                db.execute('UPDATE leases SET expires = ? WHERE worker_id = ?', (expires, worker_id))
+
+                leased = dict(db.execute('SELECT post, worker_id FROM leases'))
+                live_workers = db.execute('SELECT COUNT(*) FROM workers').fetchone()[0]
+                share = int(math.ceil(len(post_ids) / float(live_workers)))
+                posts = [p for p in post_ids if leased.get(p) == worker_id]
+                released = set(release)
+                free = [p for p in post_ids if p not in leased and p not in released]
+                taken = free[:max(0, share - len(posts))]
+                db.executemany('INSERT INTO leases VALUES (?, ?, ?)',
+                               [(post_id, worker_id, expires) for post_id in taken])
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+        return (posts + taken, expires, live_workers, share)
+
+    def release_leases(self, worker_id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM leases WHERE worker_id = ?', (worker_id,))
+            self.db.execute('DELETE FROM workers WHERE worker_id = ?', (worker_id,))
+
+    def close(self):
+        if self.lease_db is not None:
+            self.lease_db.close()
+        self.db.close()
+
+# Returns: The Store that holds the sync state.
+# Returns: The SQL statements that recreate the SQLite database in filename.
+# They are read from a copy, since closing a connection to the file itself
+# would write its write-ahead log back into it.
+def dump_copy(filename):
+    directory = tempfile.mkdtemp()
+    try:
+        copy = os.path.join(directory, 'copy.db')
+        for suffix in ['', '-wal']:
+            if os.path.isfile(filename + suffix):
+                shutil.copyfile(filename + suffix, copy + suffix)
+        source = sqlite3.connect(copy)
+        try:
+            return list(source.iterdump())
+        finally:
+            source.close()
+    finally:
+        shutil.rmtree(directory)
+
+# read_only: As for SqliteStore.
+def open_store(debug, read_only=False):
+    return SqliteStore(debug, read_only=read_only)
+
+# Copies the state saved by older versions (a pickled list of Post objects)
+# into store. The pickle file is renamed afterwards so that it is only
+# imported once.
+# store: The Store to import into.
+# filename: The pickle file written by older versions.
+# Returns: The list of Post objects that were in the pickle file.
+def migrate_pickle(store, filename=PICKLED_POSTS_FILE):
+    with open(filename) as f:
+        posts = pickle.load(f)
+    print 'Migrating', len(posts), 'posts from', filename
+    for post in posts:
+        # Older versions did not keep high-water marks
+        if not hasattr(post, 'high_water'):
+            post.high_water = { k:{} for k in post.other_ids }
+    store.import_posts(posts)
+    if not store.debug:
+        os.rename(filename, filename + '.migrated')
+    return posts
@@ -0,0 +1,148 @@
+import hashlib, hmac, json, threading
+import BaseHTTPServer, SocketServer
+from urlparse import parse_qs, urlparse
+from config import *
+from metrics import metrics
+
+# Listens for notifications that a thread has new comments, and has the
+# Scheduler poll it at once instead of at its next poll, so that new comments
+# are copied within seconds. Polling carries on as before, and picks up
+# anything that a notification misses.
+#
+#   GET /facebook   The Graph API's check when subscribing: hub.challenge is
+#                   sent back if hub.verify_token is WEBHOOK_VERIFY_TOKEN.
+#   POST /facebook  Graph API change notifications for the feed of a page,
+#                   signed in X-Hub-Signature with the app secret of a site.
+#                   Every comment syncs the post that it was made on.
+#   POST /sync      Syncs one post, given as a JSON object with either "post"
+#                   (its Disqus id) or "website" and "thread" (the id of a
+#                   thread that it copies from). "website" alone limits the
+#                   sync to that website, and "site" picks the site for
+#                   "post" if there are several.
+#
+# It listens on WEBHOOK_HOST, so notifications from Facebook need a proxy that
+# passes them on.
+class Webhook(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # scheduler: The Scheduler that polls the posts of tenants.
+    # tenants: The Tenants whose posts can be synced.
+    def __init__(self, scheduler, tenants, port, host=WEBHOOK_HOST, verify_token=WEBHOOK_VERIFY_TOKEN):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), WebhookHandler)
+        self.scheduler = scheduler
+        self.tenants = tenants
+        self.verify_token = verify_token
+        self.thread = None
+
+    # Serves requests on a background thread.
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        print 'Listening for webhooks on %s:%d' % self.server_address
+
+    # Returns: The Tenants whose Facebook app signed body with signature, a
+    #          header of the form 'sha1=<hex digest>'. Tenants without a
+    #          Facebook account are left out.
+    def signed_by(self, body, signature):
+        if not signature or not signature.startswith('sha1='):
+            return []
+        tenants = []
+        for tenant in self.tenants:
+            if FACEBOOK_STRING not in tenant.source_apis:
+                continue
+            secret = tenant.source_apis[FACEBOOK_STRING].app_secret
+            digest = hmac.new(str(secret), body, hashlib.sha1).hexdigest()
+            if hmac.compare_digest(digest, str(signature[len('sha1='):])):
+                tenants.append(tenant)
+        return tenants
+
+    # Has the Scheduler poll the post that copies from thread_id on website,
+    # if any of tenants has one.
+    # Returns: How many jobs were triggered.
+    def trigger_thread(self, tenants, website, thread_id):
+        triggered = 0
+        for tenant in tenants:
+            post = tenant.all_posts.find_thread(website, thread_id)
+            if post is not None:
+                triggered += self.scheduler.trigger(tenant.name, post.disqus_id, website)
+        metrics.count('webhook_triggers', triggered, website=website)
+        return triggered
+
+    # Returns: How many jobs were triggered by a Graph API notification.
+    def facebook(self, tenants, notification):
+        triggered = 0
+        for entry in notification.get('entry', []):
+            for change in entry.get('changes', []):
+                value = change.get('value', {})
+                if change.get('field') != 'feed' or value.get('item') != 'comment':
+                    continue
+                # post_id is '<page id>_<post id>', and the thread may be
+                # recorded either way
+                post_id = str(value.get('post_id', ''))
+                for thread_id in set([post_id, post_id.split('_')[-1]]):
+                    triggered += self.trigger_thread(tenants, FACEBOOK_STRING, thread_id)
+        return triggered
+
+    # Returns: How many jobs were triggered by a request to POST /sync.
+    def sync(self, request):
+        website = request.get('website')
+        if website is not None and website not in WEBSITES:
+            raise ValueError('Unknown website %s' % website)
+        if 'thread' in request:
+            if website is None:
+                raise ValueError('A thread needs a website')
+            return self.trigger_thread(self.tenants, website, str(request['thread']))
+        if 'post' not in request:
+            raise ValueError('Give either a post or a website and a thread')
+        triggered = 0
+        for tenant in self.tenants:
+            if request.get('site') in [None, tenant.name] and tenant.all_posts.get(request['post']):
+                triggered += self.scheduler.trigger(tenant.name, request['post'], website)
+        metrics.count('webhook_triggers', triggered, website=website or 'all')
+        return triggered
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        print 'Webhook:', format % args
+
+    def reply(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        arguments = { k:v[0] for k, v in parse_qs(url.query).items() }
+        if url.path != '/facebook':
+            return self.reply(404, json.dumps({ 'error': 'Not found' }))
+        if (arguments.get('hub.mode') != 'subscribe' or self.server.verify_token is None
+                or arguments.get('hub.verify_token') != self.server.verify_token):
+            return self.reply(403, json.dumps({ 'error': 'Wrong verify token' }))
+        self.reply(200, arguments.get('hub.challenge', ''), 'text/plain')
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError('Bad Content-Length')
+            body = self.rfile.read(length)
+            request = json.loads(body)
+            if type(request) != type({}):
+                raise ValueError('Expected a JSON object')
+            if path == '/facebook':
+                tenants = self.server.signed_by(body, self.headers.get('X-Hub-Signature'))
+                if not tenants:
+                    return self.reply(403, json.dumps({ 'error': 'Bad signature' }))
+                triggered = self.server.facebook(tenants, request)
+            elif path == '/sync':
+                triggered = self.server.sync(request)
+            else:
+                return self.reply(404, json.dumps({ 'error': 'Not found' }))
+        except ValueError as e:
+            # Includes a malformed Content-Length and badly formed JSON
+            return self.reply(400, json.dumps({ 'error': str(e) }))
+        self.reply(200, json.dumps({ 'triggered': triggered }))